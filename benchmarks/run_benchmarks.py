@@ -0,0 +1,259 @@
+'''Benchmark suite for the deepSI models, integrators, array creation and the training loop.
+
+Runs offline on synthetic data and on the cpu only. Each case is run for every combination of the swept
+batch sizes, horizons T, state sizes nx and thread counts, and records the throughput (samples/sec, where a
+sample is a window of length T as in `fit`, for the Streaming_simulator cases a sample is a single time step and these
+cases are only run with batch_size=1), the median latency per call and the peak memory of the timed section.
+The results can be compared against stored baselines to detect performance regressions.
+
+Example usage:
+    python benchmarks/run_benchmarks.py                                   #run all cases and compare to benchmarks/baselines.json
+    python benchmarks/run_benchmarks.py --cases SUBNET SUBNET_CT --T 20 200
+    python benchmarks/run_benchmarks.py --cases SUBNET SUBNET_compiled --T 20   #throughput gain and compile time of compile_unroll
+    python benchmarks/run_benchmarks.py --cases Streaming_simulator Streaming_simulator_CT   #per step latency = 1/(samples/sec)
+    python benchmarks/run_benchmarks.py --cases pHNN_SUBNET pHNN_SUBNET_fast    #throughput gain of the fast pHNN path
+    python benchmarks/run_benchmarks.py --save-baseline                   #store the current results as the new baseline
+    python benchmarks/run_benchmarks.py --fail-on-regression --tolerance 0.2
+'''
+import argparse, contextlib, io, itertools, json, os, platform, sys, time
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import deepSI as dsi
+from deepSI.fitting import compute_NMSE
+from deepSI.models import SUBNET_LPV, pHNN_SUBNET, Koopman_SUBNET, Streaming_simulator
+
+##################
+### Utilities ####
+##################
+
+def synthetic_data(N=20_000, seed=0, vector=False):
+    '''Same nonlinear system as in the README example (simulated with numpy, no downloads needed).'''
+    rng = np.random.default_rng(seed)
+    u = rng.standard_normal(N)
+    y, x = np.zeros(N), [0., 0.]
+    for k, uk in enumerate(u):
+        y[k] = x[1]*x[0]*0.1 + x[0] + rng.standard_normal()*1e-3
+        x = x[0]/(1.2+x[1]**2) + x[1]*0.4, x[1]/(1.2+x[0]**2) + x[0]*0.4 + uk*(1+x[0]**2/10)
+    data = dsi.Input_output_data(u=u, y=y, sampling_time=0.1)
+    return data.atleast_2d() if vector else data
+
+def reset_peak_memory():
+    '''Resets the peak resident set size of this process (linux only), returns False if not possible.'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def read_memory_MB(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def time_function(fun, min_time=0.5, min_repeats=3, warmup=1):
+    '''Returns the latencies in seconds of repeated calls of fun and the peak memory increase in MB during the calls.'''
+    for _ in range(warmup):
+        fun()
+    peak_reset = reset_peak_memory()
+    memory_start = read_memory_MB('VmRSS')
+    latencies, start = [], time.perf_counter()
+    while len(latencies)<min_repeats or time.perf_counter() - start < min_time:
+        t = time.perf_counter()
+        fun()
+        latencies.append(time.perf_counter() - t)
+    peak = read_memory_MB('VmHWM') if peak_reset else float('nan')
+    return np.array(latencies), max(peak - memory_start, 0.)
+
+#############
+### Cases ###
+#############
+# Each case is called as case(batch_size, T, nx) and returns (fun, samples_per_call) where fun is the timed function, 
+# optionally followed by a function returning extra metrics (evaluated after timing).
+
+def train_step_case(model, data, batch_size, T):
+    arrays, ids = model.create_arrays(data, T=T)
+    batch = [a[ids[:batch_size]] for a in arrays]
+    def fun():
+        loss = compute_NMSE(model, *batch)
+        model.zero_grad()
+        loss.backward()
+    return fun, batch_size
+
+def case_SUBNET(batch_size, T, nx):
+    data = synthetic_data()
+    nu, ny, norm = dsi.get_nu_ny_and_auto_norm(data)
+    return train_step_case(dsi.SUBNET(nu, ny, norm, nx=nx, nb=10, na=10), data, batch_size, T)
+
+def case_SUBNET_compiled(batch_size, T, nx):
+    '''SUBNET with the unroll compiled for the static T (see `SUBNET.compile_unroll`), the compile time is reported separately.'''
+    data = synthetic_data()
+    nu, ny, norm = dsi.get_nu_ny_and_auto_norm(data)
+    model = dsi.SUBNET(nu, ny, norm, nx=nx, nb=10, na=10).compile_unroll()
+    return (*train_step_case(model, data, batch_size, T), lambda: {'compile_time': sum(model.unroll_cache.compile_times.values())})
+
+def case_SUBNET_CT(batch_size, T, nx):
+    data = synthetic_data()
+    nu, ny, norm = dsi.get_nu_ny_and_auto_norm(data)
+    return train_step_case(dsi.SUBNET_CT(nu, ny, norm, nx=nx, nb=10, na=10), data, batch_size, T) #default rk4_integrator
+
+def case_pHNN_SUBNET(batch_size, T, nx):
+    data = synthetic_data()
+    nu, ny, norm = dsi.get_nu_ny_and_auto_norm(data)
+    return train_step_case(pHNN_SUBNET(nu, ny, norm, nx=nx, na=10, nb=10), data, batch_size, T)
+
+def case_pHNN_SUBNET_fast(batch_size, T, nx):
+    '''pHNN_SUBNET with fast=True (see `pHNN_SUBNET.forward_fast`), compare with the pHNN_SUBNET case for the speedup
+    (1.0-1.5x training throughput on the default shapes of the stored baselines).'''
+    data = synthetic_data()
+    nu, ny, norm = dsi.get_nu_ny_and_auto_norm(data)
+    return train_step_case(pHNN_SUBNET(nu, ny, norm, nx=nx, na=10, nb=10, fast=True), data, batch_size, T)
+
+def case_SUBNET_LPV(batch_size, T, nx):
+    data = synthetic_data(vector=True)
+    nu, ny, norm = dsi.get_nu_ny_and_auto_norm(data)
+    return train_step_case(SUBNET_LPV(nu, ny, norm, nx=nx, n_schedual=3, na=10, nb=10), data, batch_size, T)
+
+def case_Koopman_SUBNET(batch_size, T, nx):
+    data = synthetic_data()
+    nu, ny, norm = dsi.get_nu_ny_and_auto_norm(data)
+    return train_step_case(Koopman_SUBNET(nu, ny, norm, nx=nx, nb=10, na=10), data, batch_size, T)
+
+def streaming_case(model, data, T):
+    '''Per step latency of the Streaming_simulator, T steps per call (always batch_size=1, see `UNBATCHED_CASES`).'''
+    sim = Streaming_simulator(model)
+    for u, y in zip(data.u[:sim.npast], data.y[:sim.npast]):
+        sim.step(u, y)
+    u = data.u[sim.npast:sim.npast+T]
+    def fun():
+        for uk in u:
+            sim.step(uk)
+    return fun, T
+
+def case_Streaming_simulator(batch_size, T, nx):
+    data = synthetic_data(N=1_000)
+    nu, ny, norm = dsi.get_nu_ny_and_auto_norm(data)
+    return streaming_case(dsi.SUBNET(nu, ny, norm, nx=nx, nb=10, na=10), data, T)
+
+def case_Streaming_simulator_CT(batch_size, T, nx):
+    data = synthetic_data(N=1_000)
+    nu, ny, norm = dsi.get_nu_ny_and_auto_norm(data)
+    return streaming_case(dsi.SUBNET_CT(nu, ny, norm, nx=nx, nb=10, na=10), data, T)
+
+def case_past_future_arrays(batch_size, T, nx):
+    '''Creation of the arrays of 4 datasets together with the gathering of one batch.'''
+    data = [synthetic_data(N=5_000, seed=seed) for seed in range(4)]
+    rng = np.random.default_rng(0)
+    def fun():
+        arrays, ids = dsi.models.past_future_arrays(data, na=10, nb=10, T=T)
+        batch_ids = rng.choice(ids, size=batch_size, replace=False)
+        return [a[batch_ids] for a in arrays]
+    return fun, batch_size
+
+def case_fit(batch_size, T, nx, n_its=20):
+    '''Throughput of the full training loop of fit (including batching and the optimizer), per call n_its iterations.'''
+    data = synthetic_data()
+    train, val = data[:15_000], data[15_000:16_000]
+    nu, ny, norm = dsi.get_nu_ny_and_auto_norm(data)
+    model = dsi.SUBNET(nu, ny, norm, nx=nx, nb=10, na=10)
+    def fun():
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            dsi.fit(model, train, val, n_its=n_its, T=T, batch_size=batch_size, val_freq=n_its)
+    return fun, batch_size*n_its
+
+def case_SUBNET_CT_fused(batch_size, T, nx):
+    '''SUBNET_CT with the normalization folded into the networks (see `deepSI.normalization.fuse_normalization`), compare with
+    the SUBNET_CT case of the same run (about 5% faster train step when the two are timed interleaved, which is within the
+    session noise of a single configuration).'''
+    data = synthetic_data()
+    nu, ny, norm = dsi.get_nu_ny_and_auto_norm(data)
+    return train_step_case(dsi.fuse_normalization(dsi.SUBNET_CT(nu, ny, norm, nx=nx, nb=10, na=10)), data, batch_size, T)
+
+CASES = {'SUBNET': case_SUBNET, 'SUBNET_compiled': case_SUBNET_compiled, 'SUBNET_CT': case_SUBNET_CT, 'SUBNET_CT_fused': case_SUBNET_CT_fused, 'pHNN_SUBNET': case_pHNN_SUBNET, 'pHNN_SUBNET_fast': case_pHNN_SUBNET_fast, 'SUBNET_LPV': case_SUBNET_LPV, \
+         'Koopman_SUBNET': case_Koopman_SUBNET, 'Streaming_simulator': case_Streaming_simulator, \
+         'Streaming_simulator_CT': case_Streaming_simulator_CT, 'past_future_arrays': case_past_future_arrays, 'fit': case_fit}
+SLOW_CASES = ['SUBNET_compiled'] #not run by default since compiling takes tens of seconds per configuration
+UNBATCHED_CASES = ['Streaming_simulator', 'Streaming_simulator_CT'] #simulate a single sequence, run and keyed with batch_size=1 only
+
+##############
+### Runner ###
+##############
+
+def run(cases, batch_sizes, Ts, nxs, threads, min_time=0.5):
+    results = {}
+    for name, batch_size, T, nx, n_threads in itertools.product(cases, batch_sizes, Ts, nxs, threads):
+        batch_size = 1 if name in UNBATCHED_CASES else batch_size
+        key = f'{name}|batch_size={batch_size}|T={T}|nx={nx}|threads={n_threads}'
+        if key in results: #unbatched cases are run once for all the swept batch sizes
+            continue
+        torch.set_num_threads(n_threads)
+        torch.manual_seed(0)
+        fun, samples_per_call, *extra_metrics = CASES[name](batch_size, T, nx)
+        latencies, peak_MB = time_function(fun, min_time=min_time)
+        results[key] = {'samples/sec': samples_per_call/np.median(latencies), 'latency_ms': 1e3*np.median(latencies), 'peak_MB': peak_MB}
+        for extra in extra_metrics:
+            results[key].update(extra())
+        extra = ' '.join(f'{k}={v:.2f}' for k, v in list(results[key].items())[3:])
+        print(f'{key:60} {results[key]["samples/sec"]:12,.1f} samples/sec {results[key]["latency_ms"]:10.3f} ms {peak_MB:9.1f} MB {extra}')
+    return results
+
+def compare(results, baselines, tolerance=0.2):
+    '''Prints the throughput relative to the baseline and returns the keys which are more than `tolerance` slower.'''
+    regressions = []
+    for key, result in results.items():
+        if key not in baselines:
+            continue
+        ratio = result['samples/sec']/baselines[key]['samples/sec']
+        flag = ''
+        if ratio < 1 - tolerance:
+            regressions.append(key); flag = '  <-- REGRESSION'
+        print(f'{key:60} {ratio:6.2f}x baseline{flag}')
+    return regressions
+
+def machine_info():
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'python': platform.python_version(), \
+            'torch': torch.__version__, 'numpy': np.__version__, 'cpu_count': os.cpu_count()}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='+', default=[name for name in CASES if name not in SLOW_CASES], choices=list(CASES))
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[64, 256])
+    parser.add_argument('--T', nargs='+', type=int, default=[20, 100])
+    parser.add_argument('--nx', nargs='+', type=int, default=[4, 8])
+    parser.add_argument('--threads', nargs='+', type=int, default=[1])
+    parser.add_argument('--min-time', type=float, default=0.5, help='minimal time in seconds spend timing each configuration')
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='add/overwrite the results in the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slow down which is reported as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = run(args.cases, args.batch_sizes, args.T, args.nx, args.threads, min_time=args.min_time)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'machine': machine_info(), 'results': results}, f, indent=1)
+
+    stored = json.load(open(args.baseline)) if os.path.isfile(args.baseline) else {'machine': None, 'results': {}}
+    if args.save_baseline:
+        stored = {'machine': machine_info(), 'results': {**stored['results'], **results}}
+        with open(args.baseline, 'w') as f:
+            json.dump(stored, f, indent=1)
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+    print(f'\nComparison with {args.baseline} (recorded on {stored["machine"]})')
+    regressions = compare(results, stored['results'], tolerance=args.tolerance)
+    if regressions:
+        print(f'{len(regressions)} regression(s) found')
+    return 1 if (regressions and args.fail_on_regression) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+'''Export of trained SUBNET and SUBNET_CT models for deployment without deepSI, cloudpickle or the Python wrappers.
+
+`export_model` writes three graphs which include the input/output normalization:
+    step:       (x, u) -> (x_next, y)           single time step (for SUBNET_CT the integrator is unrolled at a fixed sampling time)
+    encoder:    (upast, ypast) -> x             initial state estimate
+    simulation: (upast, ypast, ufuture) -> y    full sequence simulation (encoder followed by a loop over step)
+as TorchScript (frozen, loadable with `torch.jit.load` or libtorch from C++) or as ONNX (requires the `onnx` package,
+loadable with e.g. onnxruntime). A `meta.json` describes the shapes and the sampling time.
+
+Example usage:
+    paths = deepSI.export.export_model(model, 'exported-model')
+    errors = deepSI.export.verify_export(model, 'exported-model', test) #max abs error compared to model.simulate(test)
+    step = torch.jit.load(paths['step']) #in the deployment environment
+'''
+import json, os
+from copy import deepcopy
+import numpy as np
+import torch
+from torch import nn
+from nonlinear_benchmarks import Input_output_data
+from deepSI.models import SUBNET, SUBNET_CT, past_future_arrays
+from deepSI.networks import Adaptive_integrator
+
+class Step_module(nn.Module):
+    '''Single time step (x, u) -> (x_next, y) of a SUBNET or SUBNET_CT where y = h(x, u) is the output at the current time.
+    For SUBNET_CT x_next = integrator(f_CT, x, u, sampling_time) with a fixed sampling time.'''
+    def __init__(self, model: SUBNET | SUBNET_CT, sampling_time: float=None):
+        super().__init__()
+        self.continuous_time, self.feedthrough, self.h = isinstance(model, SUBNET_CT), model.feedthrough, model.h
+        self.f = model.f_CT if self.continuous_time else model.f
+        self.integrator = model.integrator if self.continuous_time else None
+        sampling_time = model.norm.sampling_time if sampling_time is None else sampling_time
+        self.register_buffer('sampling_time', torch.as_tensor(sampling_time, dtype=torch.float32))
+
+    def forward(self, x: torch.Tensor, u: torch.Tensor):
+        y = self.h(x, u) if self.feedthrough else self.h(x)
+        if self.continuous_time:
+            x_next = self.integrator(self.f, x, u, self.sampling_time*torch.ones(x.shape[0], dtype=x.dtype, device=x.device))
+        else:
+            x_next = self.f(x, u)
+        return x_next, y
+
+class Simulation_module(nn.Module):
+    '''Simulation over ufuture starting from the encoder state, the loop over time is kept in the graph (scripted).'''
+    def __init__(self, step: nn.Module, encoder: nn.Module):
+        super().__init__()
+        self.step, self.encoder = step, encoder
+
+    def forward(self, upast: torch.Tensor, ypast: torch.Tensor, ufuture: torch.Tensor):
+        x = self.encoder(upast, ypast)
+        ys = []
+        for t in range(ufuture.shape[1]):
+            x, y = self.step(x, ufuture[:, t])
+            ys.append(y)
+        return torch.stack(ys, dim=1)
+
+def example_inputs(model: SUBNET | SUBNET_CT, batch_size: int=2):
+    '''Zero arrays with the shapes of (x, u, upast, ypast, ufuture) for tracing.'''
+    v = lambda n, *size: torch.zeros(size if n=='scalar' else size + (n,))
+    return torch.zeros(batch_size, model.nx), v(model.nu, batch_size), v(model.nu, batch_size, model.nb), \
+        v(model.ny, batch_size, model.na), v(model.nu, batch_size, 3)
+
+def export_model(model: SUBNET | SUBNET_CT, directory: str, format: str='torchscript', sampling_time: float=None) -> dict:
+    '''Exports the step, encoder and simulation graphs of the model to `directory` (see module docstring).
+
+    Args:
+        model (SUBNET | SUBNET_CT): Trained model (the model itself is not altered).
+        directory (str): Output directory, created if needed.
+        format (str, optional): 'torchscript' or 'onnx'. Default is 'torchscript'.
+        sampling_time (float, optional): Sampling time at which the integrator of a SUBNET_CT is unrolled.
+            Default is None which uses the sampling time of the training data (model.norm.sampling_time).
+
+    Returns:
+        dict: paths of 'step', 'encoder', 'simulation' and 'meta'.
+    '''
+    assert isinstance(model, (SUBNET, SUBNET_CT)), f'export is only implemented for SUBNET and SUBNET_CT, not {model.__class__.__name__}'
+    assert format in ('torchscript', 'onnx'), f"format should be 'torchscript' or 'onnx' but got {format}"
+    assert not isinstance(getattr(model, 'integrator', None), Adaptive_integrator), 'the data dependent loop of Adaptive_integrator cannot be exported, use a fixed step integrator'
+    model = deepcopy(model).cpu().eval()
+    model.unroll_cache = None
+    os.makedirs(directory, exist_ok=True)
+    ext = '.pt' if format=='torchscript' else '.onnx'
+    paths = {name: os.path.join(directory, name + ext) for name in ('step', 'encoder', 'simulation')}
+    x, u, upast, ypast, ufuture = example_inputs(model)
+    with torch.no_grad():
+        step = torch.jit.trace(Step_module(model, sampling_time).eval(), (x, u))
+        encoder = torch.jit.trace(model.encoder, (upast, ypast))
+        simulation = torch.jit.script(Simulation_module(step, encoder).eval())
+        if format=='torchscript':
+            for name, graph in (('step', step), ('encoder', encoder), ('simulation', simulation)):
+                torch.jit.save(torch.jit.freeze(graph), paths[name]) #freezing inlines the parameters for faster loading and execution
+        else:
+            batch = {0: 'batch'}
+            kwargs = dict(dynamo=False, opset_version=17)
+            torch.onnx.export(step, (x, u), paths['step'], input_names=['x', 'u'], output_names=['x_next', 'y'], \
+                              dynamic_axes={'x': batch, 'u': batch, 'x_next': batch, 'y': batch}, **kwargs)
+            torch.onnx.export(encoder, (upast, ypast), paths['encoder'], input_names=['upast', 'ypast'], output_names=['x'], \
+                              dynamic_axes={'upast': batch, 'ypast': batch, 'x': batch}, **kwargs)
+            torch.onnx.export(simulation, (upast, ypast, ufuture), paths['simulation'], input_names=['upast', 'ypast', 'ufuture'], \
+                              output_names=['yfuture'], dynamic_axes={'upast': batch, 'ypast': batch, 'ufuture': {0: 'batch', 1: 'time'}, \
+                              'yfuture': {0: 'batch', 1: 'time'}}, **kwargs)
+    meta = {'model': model.__class__.__name__, 'format': format, 'nu': model.nu, 'ny': model.ny, 'nx': model.nx, 'na': model.na, \
+            'nb': model.nb, 'feedthrough': model.feedthrough, 'sampling_time': float(step.sampling_time), \
+            'files': {name: os.path.basename(path) for name, path in paths.items()}}
+    paths['meta'] = os.path.join(directory, 'meta.json')
+    with open(paths['meta'], 'w') as f:
+        json.dump(meta, f, indent=1)
+    return paths
+
+def load_exported(directory: str) -> dict:
+    '''Loads the exported graphs as a dict of 'step', 'encoder' and 'simulation' which can be called with torch tensors (TorchScript)
+    or numpy arrays (ONNX, using onnxruntime), and the 'meta' dict.'''
+    meta = json.load(open(os.path.join(directory, 'meta.json')))
+    graphs = {'meta': meta}
+    for name, file in meta['files'].items():
+        path = os.path.join(directory, file)
+        if meta['format']=='torchscript':
+            graphs[name] = torch.jit.load(path)
+        else:
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.log_severity_level = 3 #only errors
+            session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            names = [i.name for i in session.get_inputs()]
+            graphs[name] = lambda *arrays, session=session, names=names: session.run(None, \
+                                {n: np.asarray(a, dtype=np.float32) for n, a in zip(names, arrays)})
+    return graphs
+
+def verify_export(model: SUBNET | SUBNET_CT, directory: str, data: Input_output_data) -> dict:
+    '''Simulates data with the exported simulation graph and with a loop over the exported step graph (starting from the exported
+    encoder) and returns the maximum absolute error of both compared to `model.simulate(data)`.'''
+    graphs = load_exported(directory)
+    npast = max(model.na, model.nb)
+    ysim_ref = model.simulate(data).y[npast:]
+    upast, ypast, ufuture = past_future_arrays(data, model.na, model.nb, T='sim')[0][:3]
+    onnx = graphs['meta']['format']=='onnx'
+    to_numpy = lambda a: np.asarray(a[0] if onnx else a.detach().numpy())
+    with torch.no_grad():
+        ysim_simulation = to_numpy(graphs['simulation'](upast, ypast, ufuture))[0]
+        x, ysim_step = to_numpy(graphs['encoder'](upast, ypast)), []
+        for t in range(ufuture.shape[1]):
+            x, y = graphs['step'](x, ufuture[:, t]) if onnx else graphs['step'](torch.as_tensor(x), ufuture[:, t])
+            ysim_step.append(np.asarray(y if onnx else y.numpy())[0])
+    return {'simulation': float(np.max(np.abs(ysim_simulation - ysim_ref))), 'step': float(np.max(np.abs(np.array(ysim_step) - ysim_ref)))}
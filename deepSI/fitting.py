@@ -1,11 +1,14 @@
 
 import numpy as np
 import torch
-import cloudpickle, os
+import cloudpickle, os, re
+import threading, queue, tempfile, sys
+from contextlib import contextmanager, nullcontext
 from secrets import token_urlsafe
 from copy import deepcopy
 from tqdm.auto import tqdm
 from torch import nn, optim
+import torch.distributed as dist
 from nonlinear_benchmarks import Input_output_data
 import time
 
@@ -16,42 +19,513 @@ def compute_NMSE(*A) -> torch.Tensor:
     yout = model(*xarrays, yarray)
     return torch.mean((yout-yarray)**2/model.norm.ystd**2)
 
-def data_batcher(*arrays, batch_size=256, seed=0, device=None, indices=None):
-    rng = np.random.default_rng(seed=seed)
+def compute_NMSE_chunked(*A, chunk_size:int=1000, device=None) -> torch.Tensor:
+    '''Computes the same Normalized Mean Squared Error as `compute_NMSE` but simulates the model in time chunks
+    of `chunk_size` while carrying the state over between chunks (requires `model.encoder` and `model.unroll`, and that 
+    forward is encoder + unroll, which is not the case for e.g. `SUBNET_LPV_ext_scheduled`).
+    The arrays can stay on the host since only one chunk at the time is moved to `device`, hence memory 
+    usage does not grow with the length of the sequence when used under torch.no_grad.
+    If the unroll is compiled (see `model.compile_unroll`) the last chunk is zero padded to `chunk_size` such that
+    all chunks use the same compiled graph.
+    Example usage: compute_NMSE_chunked(model, upast, ypast, ufuture, yfuture, chunk_size=1000)'''
+    model, upast, ypast, ufuture, *other, yarray = A #other is [sampling_time] for continuous time models
+    assert hasattr(model, 'unroll'), f'chunked validation requires the model to implement .unroll(x, ufuture, ...) which {model.__class__.__name__} does not'
+    mro = type(model).__mro__
+    owner = lambda name: mro.index(next(c for c in mro if name in vars(c)))
+    assert owner('forward') >= owner('unroll'), f'chunked validation requires the forward of {model.__class__.__name__} to be encoder + unroll ' \
+        'but forward is overridden in a subclass of the class which defines unroll (e.g. SUBNET_LPV_ext_scheduled), use val_chunk_size=None'
+    x = model.encoder(upast.to(device), ypast.to(device))
+    other = [o.to(device) for o in other]
+    pad = getattr(model, 'unroll_cache', None) is not None
+    squared_error_sum, n_elements = 0., 0
+    for start in range(0, ufuture.shape[1], chunk_size):
+        ychunk = yarray[:, start:start+chunk_size].to(device)
+        uchunk = ufuture[:, start:start+chunk_size].to(device)
+        if pad and uchunk.shape[1]<chunk_size:
+            uchunk = torch.cat([uchunk, uchunk.new_zeros((uchunk.shape[0], chunk_size-uchunk.shape[1]) + uchunk.shape[2:])], dim=1)
+        yout, x = model.unroll(x, uchunk, *other)
+        yout = yout[:, :ychunk.shape[1]]
+        squared_errors = (yout-ychunk)**2/model.norm.ystd**2
+        squared_error_sum = squared_error_sum + squared_errors.sum(dtype=torch.float64)
+        n_elements += squared_errors.numel()
+    return (squared_error_sum/n_elements).to(yout.dtype)
+
+def compute_NMSE_multiple_shooting(*A, n_segments:int=5, continuity_weight:float=1.) -> torch.Tensor:
+    '''Multiple shooting training loss: the NMSE of the segmented simulation (requires `model.forward_multiple_shooting`)
+    plus continuity_weight times the mean squared mismatch between the end state of each segment and the
+    encoder estimate of the start state of the next segment. The sequential depth is reduced from T to T//n_segments.
+    Example usage: fit(model, train, val, T=200, loss_fun=partial(compute_NMSE_multiple_shooting, n_segments=4))'''
+    model, *xarrays, yarray = A
+    yout, x_ends, x_starts = model.forward_multiple_shooting(*xarrays, yarray, n_segments=n_segments)
+    NMSE = torch.mean((yout-yarray)**2/model.norm.ystd**2)
+    return NMSE + continuity_weight*torch.mean((x_ends-x_starts)**2) if n_segments>1 else NMSE
+
+def adjoint_gradient_error(model: nn.Module, *arrays, loss_fun=None) -> dict:
+    '''Compares the parameter gradients of a SUBNET_CT which uses `deepSI.networks.Adjoint_integrator` with the gradients of 
+    direct backpropagation through `rk4_integrator` with the same n_steps on the batch `arrays`. Returns the 'relative_error'
+    (norm of the difference over the norm of the direct gradient), the 'max_abs_error' and the 'max_abs_grad'.
+    Example usage: adjoint_gradient_error(model, *[a[:64] for a in model.create_arrays(train, T=50)[0]])'''
+    from deepSI.networks import Adjoint_integrator, rk4_integrator
+    adjoint = model.integrator
+    assert isinstance(adjoint, Adjoint_integrator), f'model.integrator should be an Adjoint_integrator but got {adjoint}'
+    loss_fun = compute_NMSE if loss_fun is None else loss_fun
+    def gradients():
+        model.zero_grad()
+        loss_fun(model, *arrays).backward()
+        return torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None])
+    try:
+        grad_adjoint = gradients()
+        model.integrator = lambda f, x, u, dt: rk4_integrator(f, x, u, dt, n_steps=adjoint.n_steps)
+        grad_direct = gradients()
+    finally:
+        model.integrator = adjoint
+        model.zero_grad()
+    return {'relative_error': ((grad_adjoint - grad_direct).norm()/grad_direct.norm()).item(), \
+            'max_abs_error': (grad_adjoint - grad_direct).abs().max().item(), 'max_abs_grad': grad_direct.abs().max().item()}
+
+class Phase_timer:
+    '''Accumulates the wall-clock time spent in each phase of the training loop (used by `fit(profile=True)`).
+    Use as `with timer('backward'): ...`, each phase is also labeled in torch.profiler traces. 
+    For cuda devices the device is synchronized around each phase such that the timings are accurate.'''
+    def __init__(self, enabled=True, device=None):
+        self.enabled, self.times = enabled, {}
+        cuda = device is not None and torch.device(device).type=='cuda'
+        self.sync = (lambda: torch.cuda.synchronize(device)) if cuda else (lambda: None)
+
+    def __call__(self, phase):
+        return self._phase(phase) if self.enabled else nullcontext()
+
+    @contextmanager
+    def _phase(self, phase):
+        self.sync(); start = time.perf_counter()
+        with torch.profiler.record_function(phase):
+            yield
+        self.sync(); self.add(phase, time.perf_counter() - start)
+
+    def add(self, phase, dt):
+        self.times[phase] = self.times.get(phase, 0.) + dt
+
+    def attach_h(self, model: nn.Module):
+        '''Times the output function `model.h` during training (i.e. when grad is enabled) as 'h_evaluation'.'''
+        h = getattr(model, 'h', None)
+        if not self.enabled or not isinstance(h, nn.Module):
+            return []
+        def pre_hook(module, args):
+            self.sync(); self.h_start = time.perf_counter()
+        def post_hook(module, args, output):
+            if torch.is_grad_enabled():
+                self.sync(); self.add('h_evaluation', time.perf_counter() - self.h_start)
+        return [h.register_forward_pre_hook(pre_hook), h.register_forward_hook(post_hook)]
+
+    def summary(self) -> dict:
+        '''Total time in seconds per phase, where 'forward' is split in 'forward_unroll' and 'h_evaluation' (if timed)
+        and the 'optimizer_step' is the train step time excluding the forward and backward.'''
+        times = dict(self.times)
+        if 'train_step' in times:
+            times['optimizer_step'] = times.pop('train_step') - times.get('forward', 0.) - times.get('backward', 0.)
+        if 'h_evaluation' in times and 'forward' in times:
+            times['forward_unroll'] = times.pop('forward') - times['h_evaluation']
+        return times
+
+def peak_memory(device=None) -> dict:
+    '''Peak memory usage in MB of the host process (maximum resident set size) and of the cuda device if used.'''
+    memory = {}
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        memory['host_MB'] = max_rss/1024**2 if sys.platform=='darwin' else max_rss/1024 #bytes on mac, KB on linux
+    except ImportError: #not available on windows
+        pass
+    if device is not None and torch.device(device).type=='cuda':
+        memory['cuda_MB'] = torch.cuda.max_memory_allocated(device)/1024**2
+    return memory
+
+class Batch_index_sampler:
+    '''Infinite iterator of batch indices, each epoch is a new permutation of `indices` drawn using the given seed.
+    The position in the batch stream can be saved and restored with `state_dict` and `load_state_dict`.'''
+    def __init__(self, indices, batch_size=256, seed=0):
+        assert batch_size <= len(indices)
+        self.indices, self.batch_size = indices, batch_size
+        self.rng = np.random.default_rng(seed=seed)
+        self.epoch_rng_state, self.perm, self.start = None, None, 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.perm is None or self.start + self.batch_size > len(self.indices): #new epoch
+            self.epoch_rng_state = self.rng.bit_generator.state
+            self.perm, self.start = self.rng.permutation(self.indices), 0
+        batch_perm = self.perm[self.start:self.start + self.batch_size]
+        self.start += self.batch_size
+        return batch_perm
+
+    def state_dict(self):
+        return {'epoch_rng_state': self.epoch_rng_state, 'start': self.start}
+
+    def load_state_dict(self, state):
+        if state['epoch_rng_state'] is not None: #regenerate the permutation of the current epoch
+            self.rng.bit_generator.state = state['epoch_rng_state']
+            self.epoch_rng_state, self.perm = state['epoch_rng_state'], self.rng.permutation(self.indices)
+        self.start = state['start']
+
+def data_batcher(*arrays, batch_size=256, seed=0, device=None, indices=None, prefetch=0, state=None, timer=None):
+    '''Returns an infinite iterator over batches `tuple(array[batch_ids].to(device) for array in arrays)`.
+    If `prefetch>0` the batches are assembled ahead of time in a background thread (see `Prefetch_batcher`),
+    the order of the batches only depends on the seed and is thus the same for both cases. 
+    The returned iterator has a `.state_dict()` which gives the position after the last returned batch, 
+    passing it as `state` continues the batch stream from that position. An optional `Phase_timer` times the batch gathering.'''
     if indices is None:
         indices = np.arange(arrays[0].shape[0])
-    dataset_size = len(indices)
     assert all(array.shape[0] == arrays[0].shape[0] for array in arrays)
-    assert batch_size <= dataset_size
-    while True:
-        perm = rng.permutation(indices)
-        start, end = 0, batch_size
-        while end <= dataset_size:
-            batch_perm = perm[start:end]
-            yield tuple(array[batch_perm].to(device) for array in arrays) #arrays are already torch arrays
-            start, end = start + batch_size, end + batch_size
+    sampler = Batch_index_sampler(indices, batch_size=batch_size, seed=seed)
+    if state is not None:
+        sampler.load_state_dict(state)
+    if prefetch>0:
+        return Prefetch_batcher(arrays, sampler, prefetch=prefetch, device=device, timer=timer)
+    return Batcher(arrays, sampler, device=device, timer=timer)
+
+class Batcher:
+    '''Iterator which gathers the batches `tuple(array[batch_ids].to(device) for array in arrays)` synchronously.'''
+    def __init__(self, arrays, sampler, device=None, timer=None):
+        self.arrays, self.sampler, self.device = arrays, sampler, device
+        self.timer = Phase_timer(enabled=False) if timer is None else timer
+    def __iter__(self):
+        return self
+    def __next__(self):
+        batch_perm = next(self.sampler)
+        with self.timer('batch_gather'):
+            batch = tuple(array[batch_perm] for array in self.arrays) #arrays are already torch arrays
+        with self.timer('host_to_device'):
+            return tuple(b.to(self.device) for b in batch)
+    def state_dict(self):
+        return self.sampler.state_dict()
+    def close(self):
+        pass
+
+class Prefetch_batcher:
+    '''Iterator which gathers the batches in a background thread and keeps up to `prefetch` batches ready in a queue.
+
+    For cuda devices, batches of cpu tensors are gathered into pinned host buffers which are reused across iterations 
+    (`prefetch + 2` sets of buffers such that a buffer is never overwritten while it is in use) and copied with 
+    non_blocking transfers on a separate stream. These buffers are only used as staging, hence every returned batch is a 
+    fresh tensor which stays valid after later calls of `next`. Other arrays (e.g. `Window_view`) are indexed as usual.
+    '''
+    def __init__(self, arrays, sampler, prefetch=2, device=None, timer=None):
+        self.arrays, self.sampler, self.device = arrays, sampler, device
+        self.timer = Phase_timer(enabled=False) if timer is None else timer #times the waiting on the background thread
+        self.state = sampler.state_dict() #state after the last batch returned by __next__
+        cuda = device is not None and torch.device(device).type=='cuda'
+        self.pin_memory, self.stream = cuda, (torch.cuda.Stream(device=device) if cuda else None)
+        self.n_slots = prefetch + 2
+        self.buffers = [[None]*len(arrays) for _ in range(self.n_slots)]
+        self.events = [None]*self.n_slots
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.timer('batch_wait'):
+            item = self.queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        batch, event, self.state = item
+        if event is not None: #wait until the non_blocking copy is done before using the batch
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            for b in batch:
+                b.record_stream(current_stream)
+        return batch
+
+    def state_dict(self):
+        return self.state
+
+    def close(self):
+        self.stop.set()
+        while self.thread.is_alive():
+            try: #unblock the producer if it is waiting on a full queue
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout=0.01)
+
+    def _gather(self, slot, batch_perm):
+        if self.events[slot] is not None: #buffer can only be reused when the previous copy from it is done
+            self.events[slot].synchronize()
+        ids = torch.as_tensor(batch_perm)
+        batch = []
+        for k, array in enumerate(self.arrays):
+            if self.pin_memory and isinstance(array, torch.Tensor) and array.device.type=='cpu':
+                shape = (len(ids),) + tuple(array.shape[1:])
+                buffer = self.buffers[slot][k]
+                if buffer is None or buffer.shape!=shape or buffer.dtype!=array.dtype:
+                    buffer = self.buffers[slot][k] = torch.empty(shape, dtype=array.dtype, pin_memory=self.pin_memory)
+                torch.index_select(array, 0, ids, out=buffer)
+                batch.append(buffer.to(self.device, non_blocking=True))
+            elif isinstance(array, torch.Tensor):
+                batch.append(torch.index_select(array, 0, ids.to(array.device)).to(self.device))
+            else:
+                batch.append(array[batch_perm].to(self.device))
+        return tuple(batch)
+
+    def _run(self):
+        try:
+            for it, batch_perm in enumerate(self.sampler):
+                slot = it%self.n_slots
+                if self.stream is None:
+                    item = (self._gather(slot, batch_perm), None, self.sampler.state_dict())
+                else:
+                    with torch.cuda.stream(self.stream):
+                        batch = self._gather(slot, batch_perm)
+                        self.events[slot] = torch.cuda.Event()
+                        self.events[slot].record(self.stream)
+                    item = (batch, self.events[slot], self.sampler.state_dict())
+                while not self.stop.is_set():
+                    try:
+                        self.queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if self.stop.is_set():
+                    return
+        except BaseException as e:
+            self.queue.put(e)
+
+def all_reduce_gradients(model: nn.Module, loss: torch.Tensor) -> torch.Tensor:
+    '''Averages the gradients of all parameters and the loss over all ranks using a single all_reduce 
+    on a flat buffer. Returns the averaged (detached) loss.'''
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    flat = torch.cat([g.reshape(-1) for g in grads] + [loss.detach().reshape(1)])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset+g.numel()].view_as(g))
+        offset += g.numel()
+    return flat[-1]
+
+def validations_without_improvement(NRMS_val, min_delta: float=0.) -> int:
+    '''Number of validations since the best NRMS_val last improved by more than a relative amount of min_delta.'''
+    best, count = float('inf'), 0
+    for NRMS in NRMS_val:
+        if NRMS < best*(1 - min_delta):
+            best, count = NRMS, 0
+        else:
+            count += 1
+    return count
+
+def next_validation_interval(NRMS_val, interval: int, val_freq: int, max_val_freq: int, fast_improvement: float=0.05) -> int:
+    '''Adaptive validation cadence, the interval doubles (up to max_val_freq) while the validation loss improves by more
+    than a relative `fast_improvement` per validation and halves (down to val_freq) otherwise, e.g. near convergence.'''
+    if len(NRMS_val)<2:
+        return interval
+    if NRMS_val[-1] < NRMS_val[-2]*(1 - fast_improvement):
+        return min(2*interval, max_val_freq)
+    return max(interval//2, val_freq)
+
+def state_to_cpu(state):
+    '''Returns a copy of a (nested) state_dict where all tensors are detached and copied to the cpu.
+    This is a cheap snapshot which can be serialized later without blocking the training loop.'''
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: state_to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+class Checkpoint_writer:
+    '''Writes the checkpoints of `fit` to disk, by default in a background thread.
+
+    The submitted checkpoints only contain state_dict snapshots (see `state_to_cpu`) under the keys `model_keys`,
+    these are loaded into cpu copies of the model just before writing such that the file on disk has the same 
+    format as before (i.e. `cloudpickle.load(open(filename,'rb'))['best_model']` is a nn.Module).
+
+    Args:
+        model (nn.Module): Model of which the state_dicts are submitted, copied once to the cpu as a template.
+        filename (str): Path of the checkpoint file. Files are written to a temporary file first and 
+            than renamed such that a crash never leaves a corrupted checkpoint.
+        asynchronous (bool, optional): Write in a background thread. If the writer is still busy when a new
+            checkpoint is submitted only the newest pending checkpoint is written. Default is True.
+        keep_checkpoints (int, optional): If given, only the `keep_checkpoints` most recent files in the folder of `filename` 
+            whose name fully matches `prune_pattern` are kept, older ones are removed after each write. Files modified after 
+            the writer was created (e.g. live checkpoints of concurrent fits) are never removed. Default is None (keep all).
+        prune_pattern (str, optional): Regular expression of the file names which may be removed by `keep_checkpoints`. 
+            Default is None which never removes files.
+    '''
+    model_keys = ('best_model', 'last_model')
+
+    def __init__(self, model: nn.Module, filename: str, asynchronous: bool=True, keep_checkpoints: int=None, prune_pattern: str=None):
+        self.filename, self.asynchronous, self.keep_checkpoints, self.prune_pattern = filename, asynchronous, keep_checkpoints, prune_pattern
+        self.start_time = time.time() #files modified after this time are never removed
+        self.templates = {key: deepcopy(model).cpu() for key in self.model_keys}
+        self.error, self.write_time = None, 0.
+        if asynchronous:
+            self.queue = queue.Queue(maxsize=1)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def submit(self, checkpoint: dict):
+        self._raise_error()
+        if not self.asynchronous:
+            return self._write(checkpoint)
+        try: #only the newest checkpoint is relevant, thus drop the pending one if the writer is lagging behind
+            self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.queue.put(checkpoint)
+
+    def close(self, checkpoint: dict=None) -> dict:
+        '''Writes the final checkpoint (if given), waits until all writes are done and 
+        returns the final checkpoint with the models as new nn.Module objects.'''
+        if checkpoint is not None:
+            self.submit(checkpoint)
+        if self.asynchronous:
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+        return None if checkpoint is None else self._materialize(checkpoint, new_modules=True)
+
+    def _run(self):
+        while (checkpoint := self.queue.get()) is not None:
+            if self.error is None:
+                try:
+                    self._write(checkpoint)
+                except Exception as e:
+                    self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError(f'Writing the checkpoint {self.filename} failed') from self.error
+
+    def _materialize(self, checkpoint, new_modules=False):
+        d = dict(checkpoint)
+        for key in self.model_keys:
+            if isinstance(d.get(key), dict):
+                module = deepcopy(self.templates[key]) if new_modules else self.templates[key]
+                module.load_state_dict(d[key])
+                d[key] = module
+        return d
+
+    def _write(self, checkpoint):
+        start = time.perf_counter()
+        folder = os.path.dirname(self.filename)
+        fd, tmp_filename = tempfile.mkstemp(dir=folder, prefix='.tmp-', suffix='.pth')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cloudpickle.dump(self._materialize(checkpoint), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self.filename) #atomic rename
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        if self.keep_checkpoints is not None and self.prune_pattern is not None:
+            self._remove_old_checkpoints(folder)
+        self.write_time += time.perf_counter() - start
+
+    def _remove_old_checkpoints(self, folder):
+        files = []
+        for f in os.listdir(folder):
+            if re.fullmatch(self.prune_pattern, f):
+                try: #the file can be removed in the mean time by a concurrent fit
+                    files.append((os.path.getmtime(os.path.join(folder, f)), os.path.join(folder, f)))
+                except OSError:
+                    pass
+        for mtime, file in sorted(files, reverse=True)[self.keep_checkpoints:]:
+            if os.path.abspath(file) != os.path.abspath(self.filename) and mtime < self.start_time:
+                try:
+                    os.remove(file)
+                except OSError:
+                    pass
 
 def fit(model: nn.Module, train:Input_output_data, val:Input_output_data, n_its:int, T:int=50, \
         batch_size:int=256, stride:int=1, val_freq:int=250, optimizer:optim.Optimizer=None, \
-            device=None, compile_mode=None, loss_fun=compute_NMSE, val_fun=compute_NMSE):
+            device=None, compile_mode=None, loss_fun=compute_NMSE, val_fun=compute_NMSE, \
+            async_checkpoint:bool=True, keep_checkpoints:int=None, checkpoint_group:str=None, data_on_device:bool=False, prefetch:int=0, \
+            val_chunk_size:int=None, val_windows:int=None, distributed:bool=False, resume=None, \
+            max_time:float=None, patience:int=None, min_delta:float=0., max_val_freq:int=None, \
+            precision:str='float32', low_precision_data:bool=False, profile:bool=False, profile_its:tuple=None, callbacks:list=None, array_cache=None):
     """
     Trains a PyTorch model, saving the best model and tracking training/validation progress.
 
     Args:
         model (nn.Module): Neural network model to be trained. The model must implement a 
             `.create_arrays(train, T, stride)` method to generate training arrays.
-        train (Input_output_data): Training dataset.
+        train (Input_output_data): Training dataset. If u and y are memory-mapped arrays (e.g. `np.load(file, mmap_mode='r')` or a 
+            list of such datasets) the windows are read lazily from disk (see `deepSI.models.Disk_window_view`) such that the data can be larger than the memory.
         val (Input_output_data): Validation dataset.
         n_its (int): Number of training iterations (i.e., batch updates).
-        T (int, optional): Sequence length considered in the loss (unroll length). Default is 50.
+        T (int, optional): Sequence length considered in the loss (unroll length). For long T the training memory can be 
+            reduced with `model.checkpoint_unroll()` (see `deepSI.models.Unroll_checkpointing`). Default is 50.
         batch_size (int, optional): Number of samples per batch during training. Default is 256.
         stride (int, optional): Step size for generating batches from the data. Default is 1.
         val_freq (int, optional): Frequency of validation checks (in iterations). Default is 250.
         optimizer (optim.Optimizer, optional): Optimizer for training. Default is Adam if not provided.
         device (torch.device, optional): Device to move the model and data to (e.g., 'cpu', 'cuda').
-        compile_mode (optional): Optional mode for torch.compile to optimize the training step.
+        compile_mode (optional): Optional mode for torch.compile to optimize the training step. For SUBNET and SUBNET_CT 
+            `model.compile_unroll(mode)` compiles the unroll for the static T instead (see `deepSI.models.Unroll_cache`), 
+            in that case validation defaults to chunks of length T (`val_chunk_size=T`) such that it uses a single separate 
+            compiled graph instead of recompiling for the full validation length. The total compile time is returned as 'compile_time'.
         loss_fun (callable, optional): Loss function used for training. Default is `compute_NMSE`.
         val_fun (callable, optional): Function used to compute validation loss. Default is `compute_NMSE`.
+        async_checkpoint (bool, optional): Write the checkpoints in a background thread. Default is True.
+        keep_checkpoints (int, optional): Only keep the most recent `keep_checkpoints` checkpoint files of this model class 
+            in the `checkpoint_group` subdirectory, hence requires `checkpoint_group`. Only files named `{ModelClass}-{code}.pth`
+            as generated by `fit` are removed and never files modified after this fit started (e.g. the live checkpoints of 
+            parallel sweep jobs in the same group), other files and other groups are never touched. When resuming from a 
+            checkpoint path no files are removed. Default is None (keep all).
+        checkpoint_group (str, optional): Name of the subdirectory of the checkpoint directory (`get_checkpoint_dir()`) 
+            in which the checkpoint is saved (e.g. the name of a sweep), the scope of `keep_checkpoints`. Default is None 
+            (saved directly in the checkpoint directory).
+        data_on_device (bool, optional): Store the raw data once on `device` and gather the batches there 
+            (see `deepSI.models.Window_view`) instead of gathering the windows on the host. Requires that
+            `.create_arrays` accepts a `device` keyword argument. Default is False.
+        prefetch (int, optional): Number of batches which are assembled ahead of time in a background thread 
+            such that batch assembly overlaps with the train step (see `Prefetch_batcher`). Default is 0 (no prefetching).
+        val_chunk_size (int, optional): If given, validation simulates the model in time chunks of this length while carrying 
+            the state (see `compute_NMSE_chunked`) and the validation arrays are kept on the host. Gives the same 
+            value as `compute_NMSE` with bounded memory. Can only be used with the default `val_fun` and with models whose 
+            forward is encoder + unroll (not e.g. `SUBNET_LPV_ext_scheduled`). Default is None.
+        val_windows (int, optional): If given, validate on a fixed (seeded) subset of this number of windows of length `T` 
+            instead of simulating the full validation sequence. Default is None.
+        distributed (bool, optional): Data-parallel training with torch.distributed (gloo backend, such that it also runs 
+            on cpu-only machines and across nodes). Launch the script with e.g. `torchrun --nproc_per_node=8 script.py`. 
+            Each rank trains on a disjoint shard of the training windows with `batch_size//world_size` samples per batch, 
+            the gradients are averaged with an all_reduce and only rank 0 validates and writes checkpoints. 
+            All ranks return the same dict. Default is False.
+        resume (str or dict, optional): Path to (or the loaded dict of) a checkpoint written by `fit` to continue training from. 
+            The last model and optimizer state, the best model, the iteration counter, the position in the batch stream 
+            and the monitors are restored such that training continues exactly where it stopped (given the same 
+            data, T, batch_size, stride and n_its). If a path is given the checkpoint file is continued. Default is None.
+        max_time (float, optional): Wall-clock time budget in seconds. When exceeded, a final validation is done and training stops. Default is None.
+        patience (int, optional): Stop training when the best validation NRMS did not improve by more than a relative 
+            `min_delta` for `patience` validations in a row (plateau). Default is None.
+        min_delta (float, optional): Minimal relative improvement considered by `patience`. Default is 0.
+        max_val_freq (int, optional): Enables an adaptive validation cadence, the validation interval doubles up to 
+            `max_val_freq` while the validation loss is improving fast and shrinks back to `val_freq` 
+            near convergence (see `next_validation_interval`). Default is None (validate every `val_freq` iterations).
+        precision (str, optional): Either 'float32' or 'bfloat16'. With 'bfloat16' the loss (and thus the f, h and encoder 
+            networks) is computed under torch.autocast while the state is kept in float32 across the unroll. 
+            The parameters, the backward accumulation and the validation remain in float32. Default is 'float32'.
+        low_precision_data (bool, optional): Store the training arrays in bfloat16 to halve their memory, batches are cast 
+            back to float32 before the train step. Requires that `.create_arrays` accepts a `dtype` keyword argument. Default is False.
+        profile (bool, optional): Time each phase of the training loop (batch gather, host to device copy, forward unroll, 
+            h evaluation, backward, optimizer step, validation and checkpointing, see `Phase_timer`) and track the peak memory. 
+            Adds 'phase_times' and 'peak_memory' to the results. Default is False.
+        profile_its (tuple, optional): (start, stop) iterations over which a torch.profiler trace is recorded, the trace is saved 
+            next to the checkpoint as a chrome trace (.json). Default is None.
+        callbacks (list, optional): Callables called as `callback(event, info)` to stream metrics without changing the loop. 
+            event is 'train_step' (info: 'it', 'loss'), 'validation' (info: 'it', 'NRMS_train', 'NRMS_val', 'best_NRMS_val', 
+            'samples/sec' and if profiling 'phase_times' and 'peak_memory') or 'end' (info: the returned dict). Default is None.
+        array_cache (deepSI.models.Array_cache, optional): Cache of the training and validation arrays shared between fits such that
+            repeated fits on the same data with the same T and stride (e.g. a hyperparameter sweep) do not recreate the arrays.
+            Requires that `.create_arrays` accepts an `array_cache` keyword argument. Default is None.
 
     Returns:
         dict: Contains the following keys:
@@ -65,23 +539,55 @@ def fit(model: nn.Module, train:Input_output_data, val:Input_output_data, n_its:
             - 'val_freq': Validation frequency.
             - 'batch_size': Batch size used during training.
             - 'it_counter': List of iteration counts corresponding to each validation point.
+            - 'precision', 'data_dtype': The compute precision and the storage dtype of the training arrays.
+            - 'phase_times', 'peak_memory': Seconds spent per phase and the peak memory in MB (only if profile=True).
+            - 'compile_time': Seconds spend compiling the unroll graphs (only if `model.compile_unroll` was used).
+            - 'stop_reason': Why training stopped, one of 'n_its', 'max_time', 'plateau' or 'KeyboardInterrupt'.
+            - 'it_count', 'batcher_state', 'loss_acc', 'time_usage_train', 'val_interval': Training state used by `resume`.
     """
 
+    assert precision in ('float32', 'bfloat16'), f"precision should be 'float32' or 'bfloat16' but got {precision}"
+    device_type = torch.device(device).type if device is not None else 'cpu'
+    timer = Phase_timer(enabled=profile, device=device)
+    callbacks = [] if callbacks is None else callbacks
     def train_step(model, batch, optimizer):
+        if low_precision_data:
+            batch = tuple(b.float() if b.is_floating_point() else b for b in batch)
         def closure(backward=True):
-            loss = loss_fun(model, *batch)
+            with timer('forward'), torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=precision=='bfloat16'):
+                loss = loss_fun(model, *batch)
             if backward:
-                optimizer.zero_grad()
-                loss.backward()
+                with timer('backward'):
+                    optimizer.zero_grad()
+                    loss.backward()
+                    if distributed:
+                        loss = all_reduce_gradients(model, loss)
             return loss
-        loss = optimizer.step(closure) #Using closure for the case that LBFGS is used.
+        with timer('train_step'):
+            loss = optimizer.step(closure) #Using closure for the case that LBFGS is used.
         return loss.item()
     if compile_mode is not None:
         train_step = torch.compile(train_step, mode=compile_mode)
     
-    code = token_urlsafe(4).replace('_','0').replace('-','a')
-    save_filename = os.path.join(get_checkpoint_dir(), f'{model.__class__.__name__}-{code}.pth')
-    fit_info = {'val_freq': val_freq, 'batch_size':batch_size}
+    if distributed:
+        if not dist.is_initialized():
+            dist.init_process_group(backend='gloo')
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        assert batch_size%world_size==0, f'batch_size={batch_size} should be divisible by the number of ranks {world_size}'
+    else:
+        rank, world_size = 0, 1
+
+    assert keep_checkpoints is None or checkpoint_group is not None, 'keep_checkpoints requires a checkpoint_group to which the removal of old checkpoints is limited'
+    assert checkpoint_group is None or re.fullmatch(r'[\w-][\w.-]*', checkpoint_group), f'checkpoint_group should be a plain directory name but got {checkpoint_group!r}'
+    resume_path = isinstance(resume, str) #the folder of a user given path is never pruned by keep_checkpoints
+    if resume_path:
+        resume, save_filename = cloudpickle.load(open(resume,'rb')), resume
+    else:
+        code = token_urlsafe(4).replace('_','0').replace('-','a')
+        save_dir = get_checkpoint_dir() if checkpoint_group is None else os.path.join(get_checkpoint_dir(), checkpoint_group)
+        os.makedirs(save_dir, exist_ok=True)
+        save_filename = os.path.join(save_dir, f'{model.__class__.__name__}-{code}.pth')
+    fit_info = {'val_freq': val_freq, 'batch_size':batch_size, 'precision': precision, 'data_dtype': 'bfloat16' if low_precision_data else 'float32'}
     
     # Creat optimizer
     model.to(device); model.train()
@@ -93,43 +599,104 @@ def fit(model: nn.Module, train:Input_output_data, val:Input_output_data, n_its:
         except AssertionError:
             raise
         except: print('### Warning could not check if optimizer and device are on the same device ###')
+    if resume is not None:
+        model.load_state_dict(resume['last_model'].state_dict())
+        optimizer.load_state_dict(resume['last_optimizer_state'])
+    if distributed: #start all ranks from the same parameters
+        for value in model.state_dict().values():
+            dist.broadcast(value, src=0)
     
     # Create training arrays
-    arrays, indices = model.create_arrays(train, T=T, stride=stride) 
-    print(f'Number of samples to train on = {len(indices)}')
-    itter = data_batcher(*arrays, batch_size=batch_size, indices=indices, device=device)
+    array_kwargs = {'device': device if device is not None else 'cpu'} if data_on_device else {}
+    if array_cache is not None:
+        array_kwargs['array_cache'] = array_cache
+    arrays, indices = model.create_arrays(train, T=T, stride=stride, **array_kwargs, **({'dtype': torch.bfloat16} if low_precision_data else {}))
+    if rank==0: print(f'Number of samples to train on = {len(indices)}')
+    indices = indices[rank:len(indices)-len(indices)%world_size:world_size] #disjoint and equally sized shard of the training windows for each rank
+    itter = data_batcher(*arrays, batch_size=batch_size//world_size, indices=indices, device=device, prefetch=prefetch, \
+                         state=None if resume is None else resume['batcher_state'], timer=timer)
 
     # Create validation arrays
-    arrays_val, indices = model.create_arrays(val, T='sim')
-    arrays_val = [array_val[indices].to(device) for array_val in arrays_val]
+    arrays_val, indices = model.create_arrays(val, T='sim' if val_windows is None else T, **array_kwargs)
+    if val_windows is not None and val_windows<len(indices):
+        indices = np.sort(np.random.default_rng(seed=0).choice(indices, size=val_windows, replace=False))
+    unroll_cache = getattr(model, 'unroll_cache', None)
+    if val_chunk_size is None and unroll_cache is not None and val_fun is compute_NMSE and val_windows is None:
+        val_chunk_size = T #one static shape compiled graph for validation
+    if val_chunk_size is None:
+        arrays_val = [array_val[indices].to(device) for array_val in arrays_val]
+    else:
+        assert val_fun is compute_NMSE, 'val_chunk_size can only be used with the default val_fun=compute_NMSE'
+        arrays_val = [array_val[indices] for array_val in arrays_val]
+        val_fun = lambda model, *arrays: compute_NMSE_chunked(model, *arrays, chunk_size=val_chunk_size, device=device)
     
-    # Initalize all the monitors and best found models
-    best_val, best_model, best_optimizer_state, loss_acc = float('inf'), deepcopy(model), deepcopy(optimizer.state_dict()), []
-    NRMS_val, NRMS_train, time_usage_train = [], [], 0. #initialize the train and val monitor
+    # Initalize all the monitors and best found models (stored as cpu state_dicts)
+    if resume is None:
+        best_val, best_model, best_optimizer_state, loss_acc = float('inf'), state_to_cpu(model.state_dict()), state_to_cpu(optimizer.state_dict()), []
+        NRMS_val, NRMS_train, it_counter, time_usage_train, it_start = [], [], [], 0., 0 #initialize the train and val monitor
+    else:
+        best_val, best_model, best_optimizer_state = np.min(resume['NRMS_val']), resume['best_model'].state_dict(), resume['best_optimizer_state']
+        NRMS_val, NRMS_train, it_counter = list(resume['NRMS_val']), list(resume['NRMS_train']), list(resume['it_counter'])
+        loss_acc, time_usage_train, it_start = list(resume['loss_acc']), resume['time_usage_train'], resume['it_count']
+    val_interval = val_freq if resume is None else resume.get('val_interval', val_freq)
+    next_val_it = it_counter[-1] + val_interval if len(it_counter)>0 else it_start
+    start_time, stop_reason, sync_stop = time.time(), None, distributed and (max_time is not None or patience is not None)
+    hook_handles, profiler = timer.attach_h(model), None
+    prune_pattern = None if resume_path else re.escape(model.__class__.__name__) + r'-[A-Za-z0-9]{6}\.pth' #only files generated by fit in checkpoint_group
+    writer = Checkpoint_writer(model, save_filename, asynchronous=async_checkpoint, keep_checkpoints=keep_checkpoints, \
+                               prune_pattern=prune_pattern) if rank==0 else None
+    checkpoint, it_done, batcher_state = resume, it_start, itter.state_dict() #it_done and batcher_state are updated after each completed train step
     try:
-        progress_bar = tqdm(range(n_its + 1), total=n_its)
-        for it_count, batch in zip(progress_bar, itter):
-            ### Validation and printing step ###
-            if it_count%val_freq==0: #make this an or last iteration?
-                with torch.no_grad(): NRMS_val.append((val_fun(model, *arrays_val)).cpu().numpy()**0.5)
+        progress_bar = tqdm(range(it_start, n_its + 1), initial=it_start, total=n_its, disable=rank!=0)
+        for it_count in progress_bar:
+            ### Validation and printing step (only on rank 0) ###
+            if profile_its is not None and it_count==profile_its[0]:
+                profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU] + \
+                    ([torch.profiler.ProfilerActivity.CUDA] if device_type=='cuda' else []))
+                profiler.start()
+            if (it_count>=next_val_it or stop_reason is not None) and rank==0 and (len(it_counter)==0 or it_counter[-1]!=it_count): #skip if already validated before resuming
+                with timer('validation'), torch.no_grad(): NRMS_val.append((val_fun(model, *arrays_val)).cpu().numpy()**0.5)
                 NRMS_train.append((np.mean(loss_acc) if len(loss_acc)>0 else float('nan'))**0.5)
                 loss_acc = []
+                it_counter.append(it_count)
+                if max_val_freq is not None:
+                    val_interval = next_validation_interval(NRMS_val, val_interval, val_freq, max_val_freq)
+                next_val_it = it_count + val_interval
+                if patience is not None and stop_reason is None and validations_without_improvement(NRMS_val, min_delta)>=patience:
+                    stop_reason = 'plateau'
 
                 if NRMS_val[-1]<=best_val:
-                    best_val, best_model, best_optimizer_state = NRMS_val[-1], deepcopy(model).cpu(), deepcopy(optimizer.state_dict()) #does this work nicely with device?
+                    best_val, best_model, best_optimizer_state = NRMS_val[-1], state_to_cpu(model.state_dict()), state_to_cpu(optimizer.state_dict())
                 
-                #saving fit results
+                #saving fit results (serialization and writing happens in the background)
                 samps_per_sec = it_count*batch_size/time_usage_train if time_usage_train>0 else None
-                cloudpickle.dump({'best_model': best_model,            'best_optimizer_state':best_optimizer_state,\
-                                  'last_model': deepcopy(model).cpu(), 'last_optimizer_state':optimizer.state_dict(),\
-                                  'NRMS_train': np.array(NRMS_train),  'NRMS_val':np.array(NRMS_val),\
-                                  'samples/sec': samps_per_sec, **fit_info, 'it_counter' : np.arange(len(NRMS_val))*val_freq},\
-                                  open(save_filename,'wb'))
+                profile_info = {'phase_times': {**timer.summary(), 'checkpoint_write': writer.write_time}, 'peak_memory': peak_memory(device)} if profile else {}
+                with timer('checkpoint_snapshot'):
+                    checkpoint = {'best_model': best_model,                          'best_optimizer_state':best_optimizer_state,\
+                                  'last_model': state_to_cpu(model.state_dict()),    'last_optimizer_state':state_to_cpu(optimizer.state_dict()),\
+                                  'NRMS_train': np.array(NRMS_train),                'NRMS_val':np.array(NRMS_val),\
+                                  'samples/sec': samps_per_sec, **fit_info, 'it_counter' : np.array(it_counter),\
+                                  'it_count': it_count, 'batcher_state': batcher_state, 'loss_acc': [], 'time_usage_train': time_usage_train,\
+                                  'val_interval': val_interval, **profile_info}
+                    writer.submit(checkpoint)
+                for callback in callbacks:
+                    callback('validation', {'it': it_count, 'NRMS_train': NRMS_train[-1], 'NRMS_val': NRMS_val[-1], \
+                                            'best_NRMS_val': best_val, 'samples/sec': samps_per_sec, **profile_info})
                 print(f'it {it_count:7,} NRMS loss {NRMS_train[-1]:.5f} NRMS val {NRMS_val[-1]:.5f}{"!!" if NRMS_val[-1]==best_val else "  "} {(it_count*batch_size/time_usage_train if time_usage_train>0 else float("nan")):.2f} samps/sec')
             
-            if it_count==n_its: break #break upon the final iteration such to skip the added iteration
+            if sync_stop: #all ranks need to stop at the same iteration
+                stop = torch.tensor(stop_reason is not None)
+                dist.broadcast(stop, src=0)
+                stop_reason = stop_reason if rank==0 else ('stopped by rank 0' if stop else None)
+            if stop_reason is not None:
+                if rank==0: print(f'Stopping early due to {stop_reason} at it {it_count:,}')
+                break
+            if it_count==n_its: #break upon the final iteration such to skip the added iteration
+                stop_reason = 'n_its'
+                break
 
             ### Train Step ###
+            batch = next(itter)
             start_t = time.time()
             loss = train_step(model, batch, optimizer)
             time_usage_train += time.time() - start_t
@@ -138,16 +705,138 @@ def fit(model: nn.Module, train:Input_output_data, val:Input_output_data, n_its:
             if np.isnan(loss):
                 raise ValueError('Loss became NaN and training will be terminate (see: "10.1 Recovering from a crash" from the example notebook)')
             loss_acc.append(loss) # add the loss the the loss accumulator
+            it_done, batcher_state = it_count + 1, itter.state_dict()
             progress_bar.set_description(f'Sqrt loss: {loss**0.5:.5f}', refresh=False)
+            for callback in callbacks:
+                callback('train_step', {'it': it_count, 'loss': loss})
+            if profiler is not None and it_done==profile_its[1]:
+                profiler.stop(); profiler.export_chrome_trace(save_filename[:-len('.pth')] + '-trace.json'); profiler = None
+            if max_time is not None and time.time() - start_time > max_time:
+                stop_reason = 'max_time' #validates one last time at the start of the next iteration before stopping
     except KeyboardInterrupt:
         print('Stopping early due to KeyboardInterrupt')
-    d = cloudpickle.load(open(save_filename,'rb')) #save the last model to disk
-    d['last_model'], d['last_optimizer_state'] = deepcopy(model).cpu(), optimizer.state_dict()
-    cloudpickle.dump(d, open(save_filename,'wb'))
-    model.load_state_dict(best_model.state_dict()); model.cpu()
+        stop_reason = 'KeyboardInterrupt'
+    except BaseException:
+        if writer is not None: writer.close()
+        raise
+    finally:
+        itter.close()
+        for handle in hook_handles:
+            handle.remove()
+        if profiler is not None: #training stopped before the end of the profile window
+            profiler.stop(); profiler.export_chrome_trace(save_filename[:-len('.pth')] + '-trace.json')
+    #save the last model to disk
+    if rank==0:
+        d = writer.close({**(checkpoint or {}), 'last_model': state_to_cpu(model.state_dict()), 'last_optimizer_state': state_to_cpu(optimizer.state_dict()), \
+                          'it_count': it_done, 'batcher_state': batcher_state, 'loss_acc': loss_acc, 'time_usage_train': time_usage_train, \
+                          'val_interval': val_interval, 'stop_reason': stop_reason})
+        if unroll_cache is not None:
+            d['compile_time'] = sum(unroll_cache.compile_times.values())
+        if profile: #the last write is only included after closing the writer
+            d['phase_times'], d['peak_memory'] = {**timer.summary(), 'checkpoint_write': writer.write_time}, peak_memory(device)
+        for callback in callbacks:
+            callback('end', d)
+    if distributed: #send the fit results of rank 0 to all the other ranks
+        d = [d if rank==0 else None]
+        dist.broadcast_object_list(d, src=0)
+        d = d[0]
+        best_model = best_model if rank==0 else d['best_model'].state_dict()
+    model.load_state_dict(best_model); model.cpu()
     return d
 
 
+class Loss_module(nn.Module):
+    '''Wraps loss_fun(model, *batch) as a module such that it can be called with torch.func.functional_call.'''
+    def __init__(self, model: nn.Module, loss_fun):
+        super().__init__()
+        self.model, self.loss_fun = model, loss_fun
+    def forward(self, *batch):
+        return self.loss_fun(self.model, *batch)
+
+def fit_ensemble(models: list, train:Input_output_data, val:Input_output_data, n_its:int, T:int=50, \
+        batch_size:int=256, stride:int=1, val_freq:int=250, optimizer=None, device=None, \
+        loss_fun=compute_NMSE, val_fun=compute_NMSE):
+    """
+    Trains N models with an identical structure (e.g. differing only in seed or initialization) at the same time. 
+    The parameters are stacked with `torch.func.stack_module_state` and all members are evaluated in a 
+    single vectorized call using `torch.func.vmap` on the same batch stream. 
+    Models which call torch.autograd inside their forward (e.g. pHNN_SUBNET) cannot be vectorized this way.
+
+    Args:
+        models (list of nn.Module): Models with the same structure, modified in-place to the best found parameters (per member).
+        train, val, n_its, T, batch_size, stride, val_freq, device, loss_fun, val_fun: see `fit`.
+        optimizer (callable, optional): Called as optimizer(parameters) to create the optimizer for the stacked parameters. 
+            Default is torch.optim.Adam. Since Adam is elementwise this is equivalent to an Adam optimizer per member.
+
+    Returns:
+        dict: Contains the following keys:
+            - 'best_models': The models with the lowest validation loss of each member (same objects as `models`).
+            - 'last_models': Copies of the models at the end of training.
+            - 'best_member': Index of the member with the lowest validation loss.
+            - 'NRMS_train': Training loss history of shape (number of validations, N).
+            - 'NRMS_val': Validation loss history of shape (number of validations, N).
+            - 'samples/sec': Number of data samples processed per second summed over all members.
+            - 'val_freq', 'batch_size', 'it_counter': see `fit`.
+    """
+    N = len(models)
+    for model in models:
+        model.to(device); model.train()
+    params, buffers = torch.func.stack_module_state(models) #(N, ...) leaf tensors
+    optimizer = (torch.optim.Adam if optimizer is None else optimizer)(list(params.values()))
+    base = Loss_module(deepcopy(models[0]).to('meta'), loss_fun) #parameters are always replaced by the stacked ones
+    base_val = Loss_module(base.model, val_fun)
+    pre = lambda d: {f'model.{k}': v for k, v in d.items()}
+    member_loss = lambda params, buffers, batch, module: torch.func.functional_call(module, (pre(params), pre(buffers)), batch)
+    ensemble_loss = torch.func.vmap(member_loss, in_dims=(0, 0, None, None)) #(N,) loss for each member
+
+    arrays, indices = models[0].create_arrays(train, T=T, stride=stride)
+    print(f'Number of samples to train on = {len(indices)}')
+    itter = data_batcher(*arrays, batch_size=batch_size, indices=indices, device=device)
+    arrays_val, indices = models[0].create_arrays(val, T='sim')
+    arrays_val = tuple(array_val[indices].to(device) for array_val in arrays_val)
+
+    best_val, best_params = np.full(N, float('inf')), {k: v.detach().cpu().clone() for k, v in {**params, **buffers}.items()}
+    NRMS_val, NRMS_train, loss_acc, time_usage_train = [], [], [], 0.
+    try:
+        progress_bar = tqdm(range(n_its + 1), total=n_its)
+        for it_count, batch in zip(progress_bar, itter):
+            if it_count%val_freq==0:
+                with torch.no_grad(): NRMS_val.append(ensemble_loss(params, buffers, arrays_val, base_val).cpu().numpy()**0.5)
+                NRMS_train.append((np.mean(loss_acc, axis=0) if len(loss_acc)>0 else np.full(N, float('nan')))**0.5)
+                loss_acc = []
+                improved = NRMS_val[-1]<=best_val
+                best_val[improved] = NRMS_val[-1][improved]
+                for k, v in {**params, **buffers}.items():
+                    best_params[k][improved] = v.detach().cpu()[improved]
+                print(f'it {it_count:7,} NRMS loss {np.nanmin(NRMS_train[-1]):.5f} NRMS val {NRMS_val[-1].min():.5f} best member {best_val.argmin()} NRMS val {best_val.min():.5f} {(it_count*batch_size*N/time_usage_train if time_usage_train>0 else float("nan")):.2f} samps/sec')
+            if it_count==n_its: break
+
+            start_t = time.time()
+            losses = ensemble_loss(params, buffers, batch, base)
+            optimizer.zero_grad()
+            losses.sum().backward() #the members are independent thus the gradient of the sum is the gradient of each member
+            optimizer.step()
+            time_usage_train += time.time() - start_t
+
+            losses = losses.detach().cpu().numpy()
+            if np.any(np.isnan(losses)):
+                raise ValueError(f'Loss became NaN for the members {np.flatnonzero(np.isnan(losses))} and training will be terminated')
+            loss_acc.append(losses)
+            progress_bar.set_description(f'Sqrt loss: {losses.min()**0.5:.5f}', refresh=False)
+    except KeyboardInterrupt:
+        print('Stopping early due to KeyboardInterrupt')
+
+    last_models = []
+    for i, model in enumerate(models):
+        model.load_state_dict({k: v[i] for k, v in {**params, **buffers}.items()})
+        last_models.append(deepcopy(model).cpu())
+        model.load_state_dict({k: v[i] for k, v in best_params.items()}); model.cpu()
+    return {'best_models': models, 'last_models': last_models, 'best_member': int(best_val.argmin()), \
+            'NRMS_train': np.array(NRMS_train), 'NRMS_val': np.array(NRMS_val), \
+            'samples/sec': it_count*batch_size*N/time_usage_train if time_usage_train>0 else None, \
+            'val_freq': val_freq, 'batch_size': batch_size, 'it_counter': np.arange(len(NRMS_val))*val_freq}
+
+
 def get_checkpoint_dir():
     '''A utility function which gets the checkpoint directory for each OS
 
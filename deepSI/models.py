@@ -8,13 +8,297 @@ from nonlinear_benchmarks import Input_output_data
 import numpy as np
 from deepSI.normalization import Norm
 from warnings import warn
+import time, threading, hashlib, shutil, weakref
+from secrets import token_hex
+from collections import OrderedDict
+from torch.utils.checkpoint import checkpoint
 
 
 #######################
 ### Helper Function ###
 #######################
 
-def past_future_arrays(data : Input_output_data | list, na : int, nb : int, T : int | str, stride : int=1, add_sampling_time : bool=False):
+class Window_view:
+    '''Lazy sliding window array over a base tensor such that view[i] = base[i + offset : i + offset + window].
+
+    It mimics the parts of a torch array used by `data_batcher` and `fit` (`.shape`, `len`, `view[ids]` and `.to(device)`),
+    but the base is only stored once (e.g. on the target device) and each batch is gathered with index arithmetic 
+    on the device of the base. Hence, no (batch, window) copies are materialized on the host.
+    '''
+    def __init__(self, base: torch.Tensor, offset: int, window: int, length: int):
+        self.base, self.offset, self.window, self.length = base, offset, window, length
+        self.arange = torch.arange(offset, offset + window, device=base.device)
+
+    @property
+    def shape(self):
+        return (self.length, self.window) + tuple(self.base.shape[1:])
+    @property
+    def device(self):
+        return self.base.device
+    @property
+    def dtype(self):
+        return self.base.dtype
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, ids):
+        ids = torch.as_tensor(ids, device=self.base.device)
+        return self.base[ids[..., None] + self.arange] #(*ids.shape, window, ...)
+
+    def to(self, device=None, **kwargs):
+        return self if device is None else Window_view(self.base.to(device, **kwargs), self.offset, self.window, self.length)
+
+class Block_cache:
+    '''Thread-safe LRU cache of float32 blocks of `block_size` samples read from (memory-mapped) arrays, used by `Disk_window_view`.
+    On a miss the block and the next `read_ahead` blocks are read with a single sequential read.
+    The cache holds at most about `max_MB` of data, the least recently used blocks are evicted first.'''
+    def __init__(self, block_size: int=2**16, max_MB: float=512, read_ahead: int=1):
+        self.block_size, self.max_bytes, self.read_ahead = block_size, max_MB*2**20, read_ahead
+        self.blocks, self.nbytes, self.hits, self.misses = OrderedDict(), 0, 0, 0
+        self.lock = threading.Lock()
+
+    def read(self, array, start: int, stop: int) -> np.ndarray:
+        '''Returns array[start:stop] as float32.'''
+        bs = self.block_size
+        first, last = start//bs, (stop - 1)//bs
+        with self.lock:
+            parts = [self._block(array, b) for b in range(first, last + 1)]
+        part = parts[0] if len(parts)==1 else np.concatenate(parts, axis=0)
+        return part[start - first*bs : stop - first*bs]
+
+    def _block(self, array, b):
+        key = (id(array), b)
+        if key in self.blocks:
+            self.hits += 1
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+        self.misses += 1
+        bs, n_blocks = self.block_size, -(-len(array)//self.block_size)
+        stop = min(b + 1 + self.read_ahead, n_blocks)
+        data = np.array(array[b*bs:stop*bs], dtype=np.float32) #always copies, also for float32 memmaps
+        for k in range(b, stop):
+            if (id(array), k) not in self.blocks:
+                block = self.blocks[(id(array), k)] = data[(k - b)*bs:(k - b + 1)*bs]
+                self.nbytes += block.nbytes
+        while self.nbytes > self.max_bytes and len(self.blocks) > stop - b:
+            self.nbytes -= self.blocks.popitem(last=False)[1].nbytes
+        return self.blocks[key]
+
+class Disk_window_view:
+    '''Lazy sliding window array over the concatenation of (memory-mapped) arrays `segments`, such that
+    view[i] = concatenate(segments)[i + offset : i + offset + window] without ever concatenating or loading all the data.
+
+    Used by `past_future_arrays` when the data is stored in np.memmap arrays (e.g. `np.load(file, mmap_mode='r')`) such that
+    training scales to data larger than the memory. Each window is read through a shared `Block_cache` and a batch is
+    returned as a float32 torch tensor. Windows are not allowed to cross the boundary of a segment (as given by the ids
+    of `past_future_arrays`). Has the same interface as `Window_view`.
+    '''
+    def __init__(self, segments: list, starts: np.ndarray, offset: int, window: int, length: int, cache: Block_cache):
+        self.segments, self.starts, self.offset, self.window, self.length, self.cache = segments, starts, offset, window, length, cache
+
+    @property
+    def shape(self):
+        return (self.length, self.window) + tuple(self.segments[0].shape[1:])
+    @property
+    def device(self):
+        return torch.device('cpu')
+    @property
+    def dtype(self):
+        return torch.float32
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, ids):
+        ids = np.asarray(ids)
+        starts = ids.ravel() + self.offset
+        segment_ids = np.searchsorted(self.starts, starts, side='right') - 1
+        windows = [self.cache.read(self.segments[k], s - self.starts[k], s - self.starts[k] + self.window) for k, s in zip(segment_ids, starts)]
+        out = np.stack(windows) if len(windows)>0 else np.zeros((0,) + self.shape[1:], dtype=np.float32)
+        return torch.from_numpy(out.reshape(ids.shape + out.shape[1:]))
+
+    def to(self, device=None, **kwargs):
+        return self #batches are gathered on the host and moved to the device afterwards
+
+class Array_cache:
+    '''Content-addressed cache of the arrays prepared by `past_future_arrays` (the concatenated float32 u and y and the ids)
+    such that repeated fits on the same data (e.g. hyperparameter sweeps over optimizers or network widths) skip the
+    concatenation, casting and id computation. The key is the fingerprint of the data (sha256 of the contents, shapes and
+    sampling times of all datasets) together with (na, nb, T, stride, add_sampling_time).
+
+    Two tiers: an in-process LRU tier of at most about `max_MB` and, if `directory` is given, an on-disk tier of at most
+    about `max_disk_MB` (one folder of .npy files per entry, loaded memory-mapped) which is shared between processes.
+    The least recently used entries are evicted first.
+
+    The digest of an array is memoized per array object, hence arrays should not be altered in place after they were
+    used with the cache (create a new Input_output_data instead). Usage: `fit(..., array_cache=Array_cache(directory='array-cache'))`'''
+    def __init__(self, max_MB: float=1024, directory: str=None, max_disk_MB: float=10*1024):
+        self.max_bytes, self.directory, self.max_disk_bytes = max_MB*2**20, directory, max_disk_MB*2**20
+        self.entries, self.nbytes, self.digests = OrderedDict(), 0, {}
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def digest(self, x) -> str:
+        memo = self.digests.get(id(x))
+        if memo is not None and memo[0]() is x:
+            return memo[1]
+        a = np.asarray(x)
+        h = hashlib.sha256(f'{a.shape}{a.dtype}'.encode())
+        h.update(memoryview(np.ascontiguousarray(a)).cast('B'))
+        try:
+            self.digests = {k: v for k, v in self.digests.items() if v[0]() is not None} #drop arrays which were garbage collected
+            self.digests[id(x)] = (weakref.ref(x), h.hexdigest())
+        except TypeError: #not weak referenceable
+            pass
+        return h.hexdigest()
+
+    def key(self, data: Input_output_data | list, na: int, nb: int, T: int, stride: int, add_sampling_time: bool) -> str:
+        datasets = data if isinstance(data, (tuple,list)) else [data]
+        parts = [(self.digest(d.u), self.digest(d.y), repr(d.sampling_time)) for d in datasets]
+        return hashlib.sha256(repr((isinstance(data, (tuple,list)), parts, na, nb, T, stride, add_sampling_time)).encode()).hexdigest()
+
+    def get(self, key: str) -> tuple | None:
+        '''Returns (u, y, ids) or None.'''
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        folder = None if self.directory is None else os.path.join(self.directory, key)
+        if folder is None or not os.path.isdir(folder):
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        os.utime(folder) #mark as recently used
+        value = tuple(np.load(os.path.join(folder, f'{name}.npy'), mmap_mode='c') for name in ('u', 'y', 'ids'))
+        self._store(key, value)
+        return value
+
+    def put(self, key: str, value: tuple):
+        '''Stores (u, y, ids) in both tiers.'''
+        self._store(key, value)
+        if self.directory is None or os.path.isdir(os.path.join(self.directory, key)):
+            return
+        tmp = os.path.join(self.directory, f'.{key}-{token_hex(4)}')
+        os.makedirs(tmp)
+        for name, x in zip(('u', 'y', 'ids'), value):
+            np.save(os.path.join(tmp, f'{name}.npy'), x)
+        try:
+            os.rename(tmp, os.path.join(self.directory, key)) #atomic such that other processes never see a partial entry
+        except OSError: #written by another process in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._evict_disk()
+
+    def _store(self, key, value):
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = value
+                self.nbytes += sum(x.nbytes for x in value)
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                self.nbytes -= sum(x.nbytes for x in self.entries.popitem(last=False)[1])
+
+    def _evict_disk(self):
+        folders = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if not f.startswith('.')]
+        folders = sorted(folders, key=os.path.getmtime, reverse=True) #most recently used first
+        sizes = [sum(os.path.getsize(os.path.join(f, file)) for file in os.listdir(f)) for f in folders]
+        total = sum(sizes)
+        for folder, size in zip(folders[1:][::-1], sizes[1:][::-1]): #never evict the most recent entry
+            if total <= self.max_disk_bytes:
+                break
+            shutil.rmtree(folder, ignore_errors=True)
+            total -= size
+
+def state_dtype(x: torch.Tensor) -> torch.Tensor:
+    '''Casts a reduced precision (e.g. bfloat16 from autocast) state to float32 such that the state is kept in float32 across the unroll.'''
+    return x.float() if x.dtype in (torch.float16, torch.bfloat16) else x
+
+class Unroll_cache:
+    '''Cache of shape-stable (dynamic=False) torch.compile graphs of `model.unroll` keyed by
+    (batch size, T, dtype, device, grad enabled), such that the loop over time is compiled into a single graph
+    for each static T. Enable with `model.compile_unroll(mode)`. The compile time (first call) of each graph
+    is stored in `compile_times`. The compiled graphs are not pickled (a copied model recompiles on first use).
+    Note that torch._dynamo limits the number of recompilations per function (torch._dynamo.config.recompile_limit)'''
+    def __init__(self, mode: str=None):
+        self.mode, self.graphs, self.compile_times = mode, {}, {}
+
+    def __call__(self, unroll, x: torch.Tensor, ufuture: torch.Tensor, *other):
+        key = (ufuture.shape[0], ufuture.shape[1], ufuture.dtype, ufuture.device.type, torch.is_grad_enabled())
+        if key in self.graphs:
+            return self.graphs[key](x, ufuture, *other)
+        self.graphs[key] = torch.compile(unroll, mode=self.mode, dynamic=False)
+        t_start = time.time()
+        out = self.graphs[key](x, ufuture, *other)
+        self.compile_times[key] = time.time() - t_start
+        return out
+
+    def __getstate__(self):
+        return {'mode': self.mode, 'graphs': {}, 'compile_times': self.compile_times}
+
+class Unroll_checkpointing:
+    '''Segment-wise gradient checkpointing of an unroll over time. The time axis is split into segments of `segment_length`
+    time steps, during the forward only the states at the segment boundaries (and the outputs) are stored and the activations 
+    of f (and h) inside a segment are recomputed during the backward. The activation memory is thereby reduced from T steps to
+    a single segment at the cost of about one extra forward pass. Enable with `model.checkpoint_unroll(segment_length, memory_MB)`.
+
+    segment_length: int or 'auto'. With 'auto' the segment length is ceil(sqrt(T)) (minimal memory for equal sized steps) or, 
+    if `memory_MB` is given, the longest segment for which segment_length*(bytes per step) + n_segments*(bytes per boundary) fits in
+    memory_MB, where the bytes per step are measured once per (batch size, T) with a probe of a single time step.'''
+    def __init__(self, segment_length: int | str='auto', memory_MB: float=None):
+        assert segment_length=='auto' or (isinstance(segment_length, int) and segment_length>0), f"segment_length should be a positive int or 'auto' but got {segment_length}"
+        self.segment_length, self.memory_MB, self.segment_lengths = segment_length, memory_MB, {}
+
+    def get_segment_length(self, segment_fun, x: torch.Tensor, *sequences) -> int:
+        T = sequences[0].shape[1]
+        if self.segment_length!='auto':
+            return min(self.segment_length, T)
+        if self.memory_MB is None:
+            return int(np.ceil(T**0.5))
+        key = (x.shape[0], T, x.dtype, x.device.type)
+        if key not in self.segment_lengths:
+            storages = {}
+            def pack(t):
+                storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+                return t
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+                segment_fun(x, *[seq[:, :1] for seq in sequences])
+            step_bytes, boundary_bytes, budget = sum(storages.values()), x.nbytes, self.memory_MB*2**20
+            fits = [S for S in range(T, 0, -1) if S*step_bytes + -(-T//S)*boundary_bytes <= budget]
+            if fits:
+                self.segment_lengths[key] = fits[0]
+            else:
+                self.segment_lengths[key] = max(1, int(round((T*boundary_bytes/step_bytes)**0.5))) #minimal memory
+                warn(f'Unroll_checkpointing: memory_MB={self.memory_MB} is too small for T={T}, using the minimal memory segment length {self.segment_lengths[key]}')
+        return self.segment_lengths[key]
+
+    def __call__(self, segment_fun, x: torch.Tensor, *sequences):
+        '''segment_fun(x, *sequences) -> (outputs, x_end) where the sequences and outputs have the time on dim 1.'''
+        if not torch.is_grad_enabled():
+            return segment_fun(x, *sequences)
+        S = self.get_segment_length(segment_fun, x, *sequences)
+        outputs = []
+        for start in range(0, sequences[0].shape[1], S):
+            out, x = checkpoint(segment_fun, x, *[seq[:, start:start + S] for seq in sequences], use_reentrant=False)
+            outputs.append(out)
+        return torch.cat(outputs, dim=1), x
+
+class Unroll_compile_mixin:
+    '''Adds `compile_unroll` to a model whose `unroll` uses `self.unroll_cache`.'''
+    def compile_unroll(self, mode: str=None):
+        '''Compiles `unroll` with torch.compile for static shapes (see `Unroll_cache`), used by forward, simulation and 
+        chunked validation. Each new (batch size, T) triggers one compilation. Use mode=False to go back to eager.'''
+        self.unroll_cache = None if mode is False else Unroll_cache(mode)
+        return self
+
+class Unroll_checkpointing_mixin:
+    '''Adds `checkpoint_unroll` to a model whose `unroll` uses `self.unroll_checkpointing`.'''
+    def checkpoint_unroll(self, segment_length: int | str='auto', memory_MB: float=None):
+        '''Enables segment-wise gradient checkpointing of `unroll` (see `Unroll_checkpointing`) such that training with 
+        long T requires the activation memory of a single segment. Use segment_length=None to disable.'''
+        self.unroll_checkpointing = None if segment_length is None else Unroll_checkpointing(segment_length, memory_MB)
+        return self
+
+def past_future_arrays(data : Input_output_data | list, na : int, nb : int, T : int | str, stride : int=1, add_sampling_time : bool=False, device=None, dtype=None, cache=None, array_cache=None):
     '''
     This function extracts sections from the given data as to be used in the SUBNET structure in the format (upast, ypast, ufuture, yfuture), ids. 
     
@@ -35,6 +319,15 @@ def past_future_arrays(data : Input_output_data | list, na : int, nb : int, T :
     - T (int or str): Length of future time window (`ufuture`, `yfuture`). If 'sim', uses the full length of the input data.
     - stride (int, optional): Step size for moving window across data (default is 1).
     - add_sampling_time (bool, optional): If True, includes a `sampling_time` array, representing sampling intervals (default is False).
+    - device (torch.device, optional): If given, `u` and `y` are stored once on this device and the windowed arrays are 
+      returned as `Window_view` objects which gather batches directly on the device (default is None).
+    - dtype (torch.dtype, optional): Storage dtype of `u` and `y`, e.g. torch.bfloat16 to halve the memory of the stored 
+      data (default is None which uses float32).
+    - cache (Block_cache, optional): If u or y of the data is a np.memmap (e.g. `np.load(file, mmap_mode='r')`, a list of those can be 
+      used as a chunked on-disk dataset) the data is never loaded or concatenated as a whole, instead the windowed arrays are returned as 
+      `Disk_window_view` objects which read the batches lazily through this read-ahead cache (default is None which creates a `Block_cache()`).
+    - array_cache (Array_cache, optional): Reuses the concatenated u, y and the ids between calls with the same data and arguments
+      (e.g. repeated fits in a hyperparameter sweep). Not used for memory-mapped data (default is None).
 
     Returns:
     - Tuple of Tensors: `(upast, ypast, ufuture, yfuture, [optional sampling_time])` where each array is shaped for efficient batch training.
@@ -48,33 +341,62 @@ def past_future_arrays(data : Input_output_data | list, na : int, nb : int, T :
         else:
             T = len(data) - max(na, nb)
     
-    if isinstance(data, (tuple,list)):
-        u, y = np.concatenate([di.u for di in data], dtype=np.float32), np.concatenate([di.y for di in data], dtype=np.float32) #this always creates a copy
+    datasets = data if isinstance(data, (tuple,list)) else [data]
+    out_of_core = device is None and dtype in (None, torch.float32) and any(isinstance(d.u, np.memmap) or isinstance(d.y, np.memmap) for d in datasets)
+    npast = max(na, nb)
+    key = None if array_cache is None or out_of_core else array_cache.key(data, na, nb, T, stride, add_sampling_time)
+    cached = None if key is None else array_cache.get(key)
+    if cached is not None:
+        u, y, ids = cached
     else:
-        u, y = data.u.astype(np.float32, copy=False), data.y.astype(np.float32, copy=False)
+        if isinstance(data, (tuple,list)):
+            acc_L, ids = 0, []
+            for d in data:
+                assert len(d.u)>=npast+T, f'some dataset was shorter than the length required by {max(na,nb)+T=} {len(d.u)=}'
+                ids.append(np.arange(0,len(d.u)-npast-T+1, stride) + acc_L) #only add ids which are valid for training (no overlap between the different datasets)
+                acc_L += len(d.u)
+            ids = np.concatenate(ids)
+        else:
+            ids = np.arange(0, len(data)-npast-T+1, stride)
+    if not out_of_core and cached is None: #otherwise u and y are read lazily by the Disk_window_views below
+        if isinstance(data, (tuple,list)):
+            u, y = np.concatenate([di.u for di in data], dtype=np.float32), np.concatenate([di.y for di in data], dtype=np.float32) #this always creates a copy
+        elif key is not None: #the cache should not share memory with data
+            u, y = np.array(data.u, dtype=np.float32), np.array(data.y, dtype=np.float32)
+        else:
+            u, y = data.u.astype(np.float32, copy=False), data.y.astype(np.float32, copy=False)
+        if key is not None:
+            array_cache.put(key, (u, y, ids))
+    if not out_of_core:
+        if dtype is not None and dtype!=torch.float32: #reduced precision storage (torch since numpy has no bfloat16)
+            u, y = torch.as_tensor(u).to(dtype), torch.as_tensor(y).to(dtype)
 
     def window(x,window_shape=T): 
+        if isinstance(x, torch.Tensor):
+            return x.unfold(0, window_shape, 1).movedim(-1, 1) #also a view without copying
         x = np.lib.stride_tricks.sliding_window_view(x, window_shape=window_shape,axis=0, writeable=True) #this windowing function does not increase the amount of data used.
         s = (0,len(x.shape)-1) + tuple(range(1,len(x.shape)-1))
         return x.transpose(s)
 
-    npast = max(na, nb)
-    ufuture = window(u[npast:len(u)], window_shape=T)
-    yfuture = window(y[npast:len(y)], window_shape=T)
-    upast = window(u[npast-nb:len(u)-T], window_shape=nb)
-    ypast = window(y[npast-na:len(y)-T], window_shape=na)
-
-    if isinstance(data, (tuple,list)):
-        acc_L, ids = 0, []
-        for d in data:
-            assert len(d.u)>=npast+T, f'some dataset was shorter than the length required by {max(na,nb)+T=} {len(d.u)=}'
-            ids.append(np.arange(0,len(d.u)-npast-T+1, stride) + acc_L) #only add ids which are valid for training (no overlap between the different datasets)
-            acc_L += len(d.u)
-        ids = np.concatenate(ids)
+    if out_of_core:
+        cache = Block_cache() if cache is None else cache
+        starts = np.cumsum([0] + [len(d) for d in datasets])[:-1]
+        L = sum(len(d) for d in datasets) - npast - T + 1
+        us, ys = [d.u for d in datasets], [d.y for d in datasets]
+        upast, ypast = Disk_window_view(us, starts, npast - nb, nb, L, cache), Disk_window_view(ys, starts, npast - na, na, L, cache)
+        ufuture, yfuture = Disk_window_view(us, starts, npast, T, L, cache), Disk_window_view(ys, starts, npast, T, L, cache)
+    elif device is not None:
+        L = len(u) - npast - T + 1
+        ub, yb = torch.as_tensor(u, device=device), torch.as_tensor(y, device=device)
+        upast, ypast = Window_view(ub, npast - nb, nb, L), Window_view(yb, npast - na, na, L)
+        ufuture, yfuture = Window_view(ub, npast, T, L), Window_view(yb, npast, T, L)
     else:
-        ids = np.arange(0, len(data)-npast-T+1, stride)
+        ufuture = window(u[npast:len(u)], window_shape=T)
+        yfuture = window(y[npast:len(y)], window_shape=T)
+        upast = window(u[npast-nb:len(u)-T], window_shape=nb)
+        ypast = window(y[npast-na:len(y)-T], window_shape=na)
 
-    s = torch.as_tensor
+    s = lambda x: x if isinstance(x, (Window_view, Disk_window_view)) else torch.as_tensor(x)
     if not add_sampling_time:
         return (s(upast), s(ypast), s(ufuture), s(yfuture)), ids #this could return all the valid indicies
     else:
@@ -82,8 +404,60 @@ def past_future_arrays(data : Input_output_data | list, na : int, nb : int, T :
             sampling_time = torch.cat([torch.as_tensor(d.sampling_time,dtype=torch.float32)*torch.ones(len(d)) for d in data])[:len(upast)]
         else:
             sampling_time = torch.as_tensor(data.sampling_time,dtype=torch.float32)*torch.ones(len(upast))
+        sampling_time = sampling_time if device is None else sampling_time.to(device)
         return (s(upast), s(ypast), s(ufuture), sampling_time, s(yfuture)), ids
 
+def simulate_batched(model: nn.Module, data: list, add_sampling_time: bool=False) -> list:
+    '''Simulates a list of datasets with possibly different lengths in a single batched forward (used by `model.simulate(data, batched=True)`).
+    Each dataset is zero padded at the end up to the longest length such that all experiments are unrolled together, since the 
+    models are causal the padding does not influence the simulated outputs which are cut back to the length of each dataset.'''
+    npast, L = max(model.na, model.nb), max(len(d) for d in data)
+    pad = lambda x: np.concatenate([x, np.zeros((L - len(x),) + x.shape[1:], dtype=x.dtype)], axis=0)
+    padded = [Input_output_data(u=pad(d.u), y=pad(d.y), sampling_time=d.sampling_time) for d in data]
+    arrays, ids = past_future_arrays(padded, model.na, model.nb, T='sim', add_sampling_time=add_sampling_time)
+    with torch.no_grad():
+        ysim = model(*[a[ids] for a in arrays]).numpy() #(Ndatasets, L - npast, ...)
+    return [Input_output_data(u=d.u, y=np.concatenate([d.y[:npast], ysim[i, :len(d) - npast]], axis=0), \
+                              state_initialization_window_length=npast) for i, d in enumerate(data)]
+
+def simulate_chunked(model: nn.Module, data: Input_output_data, chunk_size: int=10_000, out: np.ndarray=None, add_sampling_time: bool=False):
+    '''Simulates data with a memory usage which does not grow with the length of the data (used by `model.simulate(data, chunk_size=...)`).
+    The state is carried over between chunks of `chunk_size` samples with `model.unroll` under torch.no_grad such that only one chunk 
+    of inputs, states and outputs is held in memory. The outputs are written directly into `out`, an array with the shape of data.y 
+    which can be preallocated or a np.memmap for records which do not fit in memory (by default a new array is created).'''
+    npast = max(model.na, model.nb)
+    out = np.empty(data.y.shape, dtype=np.result_type(data.y.dtype, np.float32)) if out is None else out
+    assert out.shape==data.y.shape, f'out should have the same shape as data.y {data.y.shape} but got {out.shape}'
+    out[:npast] = data.y[:npast]
+    device = next(model.parameters()).device
+    batch = lambda a: torch.as_tensor(np.asarray(a, dtype=np.float32), device=device)[None] #only converts a single chunk
+    other = [torch.as_tensor(data.sampling_time, dtype=torch.float32, device=device).reshape(1)] if add_sampling_time else []
+    pad = getattr(model, 'unroll_cache', None) is not None #the last chunk is padded such that a compiled unroll does not recompile
+    with torch.no_grad():
+        x = state_dtype(model.encoder(batch(data.u[npast-model.nb:npast]), batch(data.y[npast-model.na:npast])))
+        for start in range(npast, len(data), chunk_size):
+            uchunk = batch(data.u[start:start+chunk_size])
+            n = uchunk.shape[1]
+            if pad and n<chunk_size:
+                uchunk = torch.cat([uchunk, uchunk.new_zeros((1, chunk_size-n) + uchunk.shape[2:])], dim=1)
+            ychunk, x = model.unroll(x, uchunk, *other)
+            out[start:start+n] = ychunk[0, :n].cpu().numpy()
+    return Input_output_data(u=data.u, y=out, state_initialization_window_length=npast)
+
+def shooting_segments(upast: torch.Tensor, ypast: torch.Tensor, ufuture: torch.Tensor, yfuture: torch.Tensor, n_segments: int):
+    '''Splits the future into n_segments segments of length T//n_segments and returns the past windows at the start
+    of each segment together with the segmented ufuture (similar to SUBNET_LPV_ext_scheduled but only at the segment starts).
+    Returns (upasts, ypasts, usegments) with shapes (Nbatch*n_segments, nb, ...), (Nbatch*n_segments, na, ...)
+    and (Nbatch*n_segments, T//n_segments, ...)'''
+    Nbatch, T = ufuture.shape[:2]
+    assert T%n_segments==0, f'the future length T={T} should be divisible by the number of segments n_segments={n_segments}'
+    L, nb, na = T//n_segments, upast.shape[1], ypast.shape[1]
+    #the window at the start of segment k is [upast, ufuture][:, k*L:k*L+nb] and similarly for y
+    windows = lambda past, future, n: torch.cat([past, future[:,:T-L]], dim=1).unfold(1, n, L).movedim(-1, 2).flatten(0, 1)
+    upasts, ypasts = windows(upast, ufuture, nb), windows(ypast, yfuture, na)
+    usegments = ufuture.unflatten(1, (n_segments, L)).flatten(0, 1)
+    return upasts, ypasts, usegments
+
 def validate_SUBNET_structure(model):
     nx, nu, ny, na, nb = model.nx, model.nu, model.ny, model.na, model.nb
     v = lambda *size: torch.randn(size)
@@ -115,7 +489,7 @@ def validate_SUBNET_structure(model):
 # see: https://www.sciencedirect.com/science/article/pii/S0005109823003710
 # Beintema, Gerben I., Maarten Schoukens, and Roland Tóth. "Deep subspace encoders for nonlinear system identification." Automatica 156 (2023): 111210.
 
-class SUBNET(nn.Module):
+class SUBNET(Unroll_compile_mixin, Unroll_checkpointing_mixin, nn.Module):
     def __init__(self, nu:int|str, ny:int|str, norm : Norm, nx:int=10, nb:int=20, na:int=20, \
                  f=None, h=None, encoder=None, feedthrough=False, validate=True) -> None:
         super().__init__()
@@ -126,8 +500,8 @@ class SUBNET(nn.Module):
         if validate:
             validate_SUBNET_structure(self)
 
-    def create_arrays(self, data: Input_output_data | list, T : int=50, stride: int=1):
-        return past_future_arrays(data, self.na, self.nb, T=T, stride=stride)
+    def create_arrays(self, data: Input_output_data | list, T : int=50, stride: int=1, **kwargs):
+        return past_future_arrays(data, self.na, self.nb, T=T, stride=stride, **kwargs)
 
     def forward_simple(self, upast: torch.Tensor, ypast: torch.Tensor, ufuture: torch.Tensor, yfuture: torch.Tensor=None):
         #is a lot simplier but also about 50% slower
@@ -140,24 +514,56 @@ class SUBNET(nn.Module):
         return torch.stack(yfuture_sim, dim=1)
 
     def forward(self, upast: torch.Tensor, ypast: torch.Tensor, ufuture: torch.Tensor, yfuture: torch.Tensor=None):
+        x = state_dtype(self.encoder(upast, ypast))
+        return self.unroll(x, ufuture)[0]
+
+    def unroll(self, x: torch.Tensor, ufuture: torch.Tensor):
+        '''Simulates from the initial state x over ufuture and returns (yfuture_sim, x) where x is the state after the last time step.
+        This allows for a simulation in chunks by carrying x over to the next chunk.'''
+        if getattr(self, 'unroll_cache', None) is not None and not torch.compiler.is_compiling():
+            return self.unroll_cache(self.unroll, x, ufuture)
+        if getattr(self, 'unroll_checkpointing', None) is not None:
+            return self.unroll_checkpointing(self.unroll_segment, x, ufuture)
+        return self.unroll_segment(x, ufuture)
+
+    def unroll_segment(self, x: torch.Tensor, ufuture: torch.Tensor):
         B, T = ufuture.shape[:2]
-        x = self.encoder(upast, ypast)
         xfuture = []
         for u in ufuture.swapaxes(0,1): #unroll over time dim
             xfuture.append(x)
-            x = self.f(x,u)
+            x = state_dtype(self.f(x,u))
         xfuture = torch.stack(xfuture,dim=1) #has shape (Nbatch, Ntime=T, nx)
 
         #compute output at all the future time indicies at the same time by combining the time and batch dim.
         fl = lambda ar: torch.flatten(ar, start_dim=0, end_dim=1) #conbine batch dim and time dim (Nbatch, Ntime, ...) -> (Nbatch*Ntim, ...)
         yfuture_sim_flat = self.h(fl(xfuture), fl(ufuture)) if self.feedthrough else self.h(fl(xfuture)) #compute the output for all time and and batches in one go
-        return torch.unflatten(yfuture_sim_flat, dim=0, sizes=(B,T)) #(Nbatch*T, ...) -> (Nbatch, T, ...)
-
-    def simulate(self, data: Input_output_data | list):
-        if isinstance(data, (list, tuple)):
-            return [self.simulate(d) for d in data]
-        if data.sampling_time!=self.norm.sampling_time:
+        return torch.unflatten(yfuture_sim_flat, dim=0, sizes=(B,T)), x #(Nbatch*T, ...) -> (Nbatch, T, ...)
+
+    def forward_multiple_shooting(self, upast: torch.Tensor, ypast: torch.Tensor, ufuture: torch.Tensor, yfuture: torch.Tensor, n_segments: int=5):
+        '''Multiple shooting: splits the future in n_segments segments which are all initialized with the encoder
+        and simulated in parallel, reducing the sequential depth from T to T//n_segments.
+        Returns (yfuture_sim, x_ends, x_starts) where x_ends[:,k] is the state at the end of segment k and x_starts[:,k]
+        the encoder estimate at the start of segment k+1 such that (x_ends - x_starts) can be used as a continuity penalty.'''
+        Nbatch, K = ufuture.shape[0], n_segments
+        upasts, ypasts, usegments = shooting_segments(upast, ypast, ufuture, yfuture, K)
+        x0 = state_dtype(self.encoder(upasts, ypasts))
+        ysegments, xend = self.unroll(x0, usegments)
+        x0, xend = x0.unflatten(0, (Nbatch, K)), xend.unflatten(0, (Nbatch, K))
+        return ysegments.unflatten(0, (Nbatch, K)).flatten(1, 2), xend[:,:-1], x0[:,1:]
+
+    def simulate(self, data: Input_output_data | list, batched: bool=False, chunk_size: int=None, out: np.ndarray=None):
+        '''Simulates the model on data (or a list of datasets) using the encoder to initialize the state. 
+        With batched=True a list of datasets (which can have different lengths) is simulated in one batched forward (see `simulate_batched`).
+        With chunk_size and/or out the simulation uses a constant amount of memory and writes the output into out (see `simulate_chunked`).'''
+        if isinstance(data, (list, tuple)) and not batched:
+            assert out is None, 'out can only be given when simulating a single dataset'
+            return [self.simulate(d, chunk_size=chunk_size) for d in data]
+        if any(d.sampling_time!=self.norm.sampling_time for d in (data if isinstance(data, (list, tuple)) else [data])):
             warn('It seems that the model is being simulated at a different sampling time as it was trained on.')
+        if isinstance(data, (list, tuple)):
+            return simulate_batched(self, data, add_sampling_time=False)
+        if chunk_size is not None or out is not None:
+            return simulate_chunked(self, data, chunk_size=10_000 if chunk_size is None else chunk_size, out=out, add_sampling_time=False)
         ysim = self(*past_future_arrays(data, self.na, self.nb, T='sim', add_sampling_time=False)[0])[0].detach().numpy()
         return Input_output_data(u=data.u, y=np.concatenate([data.y[:max(self.na, self.nb)],ysim],axis=0), state_initialization_window_length=max(self.na, self.nb))
 
@@ -174,7 +580,7 @@ class SUBNET(nn.Module):
 # see: https://arxiv.org/abs/2204.09405
 #  Beintema, G. I., Schoukens, M., & Tóth, R. (2022). Continuous-time identification  of dynamic state-space models by deep subspace encoding. Presented at the 11th International Conference on Learning Representations (ICLR)
 
-class SUBNET_CT(nn.Module):
+class SUBNET_CT(Unroll_compile_mixin, Unroll_checkpointing_mixin, nn.Module):
     #both norm, base_sampling_time have a sample time 
     def __init__(self, nu, ny, norm:Norm, nx=10, nb=20, na=20, f_CT=None, h=None, encoder=None, integrator=None, feedthrough=False, validate=True) -> None:
         super().__init__()
@@ -186,28 +592,57 @@ class SUBNET_CT(nn.Module):
         if validate:
             validate_SUBNET_structure(self)
 
-    def create_arrays(self, data: Input_output_data | list, T : int=50, stride: int=1):
-        return past_future_arrays(data, self.na, self.nb, T=T, stride=stride, add_sampling_time=True)
+    def create_arrays(self, data: Input_output_data | list, T : int=50, stride: int=1, **kwargs):
+        return past_future_arrays(data, self.na, self.nb, T=T, stride=stride, add_sampling_time=True, **kwargs)
 
     def forward(self, upast: torch.Tensor, ypast: torch.Tensor, ufuture: torch.Tensor, sampling_time : float | torch.Tensor, yfuture: torch.Tensor=None):
+        x = state_dtype(self.encoder(upast, ypast))
+        return self.unroll(x, ufuture, sampling_time)[0]
+
+    def unroll(self, x: torch.Tensor, ufuture: torch.Tensor, sampling_time : float | torch.Tensor):
+        '''Simulates from the initial state x over ufuture and returns (yfuture_sim, x) where x is the state after the last time step.'''
+        if getattr(self, 'unroll_cache', None) is not None and not torch.compiler.is_compiling():
+            return self.unroll_cache(self.unroll, x, ufuture, sampling_time)
+        if getattr(self, 'unroll_checkpointing', None) is not None:
+            return self.unroll_checkpointing(lambda x, ufuture: self.unroll_segment(x, ufuture, sampling_time), x, ufuture)
+        return self.unroll_segment(x, ufuture, sampling_time)
+
+    def unroll_segment(self, x: torch.Tensor, ufuture: torch.Tensor, sampling_time : float | torch.Tensor):
         B, T = ufuture.shape[:2]
-        x = self.encoder(upast, ypast)
         xfuture = []
         for u in ufuture.swapaxes(0,1):
             xfuture.append(x)
-            x = self.integrator(self.f_CT, x, u, sampling_time)
+            x = state_dtype(self.integrator(self.f_CT, x, u, sampling_time))
         xfuture = torch.stack(xfuture,dim=1) #has shape (Nbatch, Ntime=T, nx)
 
         #compute output at all the future time indicies at the same time by combining the time and batch dim.
         fl = lambda ar: torch.flatten(ar, start_dim=0, end_dim=1) #conbine batch dim and time dim 
         yfuture_sim_flat = self.h(fl(xfuture), fl(ufuture)) if self.feedthrough else self.h(fl(xfuture)) #compute the output for all time and and batches in one go
-        return torch.unflatten(yfuture_sim_flat, dim=0, sizes=(B,T)) #(Nbatch*T) -> (Nbatch, T)
-    
-    def simulate(self, data: Input_output_data | list):
-        if isinstance(data, (list, tuple)):
-            return [self.simulate(d) for d in data]
-        if data.sampling_time!=self.norm.sampling_time:
+        return torch.unflatten(yfuture_sim_flat, dim=0, sizes=(B,T)), x #(Nbatch*T) -> (Nbatch, T)
+
+    def forward_multiple_shooting(self, upast: torch.Tensor, ypast: torch.Tensor, ufuture: torch.Tensor, sampling_time : float | torch.Tensor, yfuture: torch.Tensor, n_segments: int=5):
+        '''Multiple shooting version of forward, see `SUBNET.forward_multiple_shooting`.'''
+        Nbatch, K = ufuture.shape[0], n_segments
+        upasts, ypasts, usegments = shooting_segments(upast, ypast, ufuture, yfuture, K)
+        sampling_time = sampling_time.repeat_interleave(K) if isinstance(sampling_time, torch.Tensor) and sampling_time.ndim>0 else sampling_time
+        x0 = state_dtype(self.encoder(upasts, ypasts))
+        ysegments, xend = self.unroll(x0, usegments, sampling_time)
+        x0, xend = x0.unflatten(0, (Nbatch, K)), xend.unflatten(0, (Nbatch, K))
+        return ysegments.unflatten(0, (Nbatch, K)).flatten(1, 2), xend[:,:-1], x0[:,1:]
+
+    def simulate(self, data: Input_output_data | list, batched: bool=False, chunk_size: int=None, out: np.ndarray=None):
+        '''Simulates the model on data (or a list of datasets) using the encoder to initialize the state. 
+        With batched=True a list of datasets (which can have different lengths) is simulated in one batched forward (see `simulate_batched`).
+        With chunk_size and/or out the simulation uses a constant amount of memory and writes the output into out (see `simulate_chunked`).'''
+        if isinstance(data, (list, tuple)) and not batched:
+            assert out is None, 'out can only be given when simulating a single dataset'
+            return [self.simulate(d, chunk_size=chunk_size) for d in data]
+        if any(d.sampling_time!=self.norm.sampling_time for d in (data if isinstance(data, (list, tuple)) else [data])):
             warn('It seems that the model is being simulated at a different sampling time as it was trained on. The encoder currently assumes that the sampling_time is kept constant')
+        if isinstance(data, (list, tuple)):
+            return simulate_batched(self, data, add_sampling_time=True)
+        if chunk_size is not None or out is not None:
+            return simulate_chunked(self, data, chunk_size=10_000 if chunk_size is None else chunk_size, out=out, add_sampling_time=True)
         ysim = self(*past_future_arrays(data, self.na, self.nb, T='sim', add_sampling_time=True)[0])[0].detach().numpy()
         return Input_output_data(u=data.u, y=np.concatenate([data.y[:max(self.na, self.nb)],ysim],axis=0), state_initialization_window_length=max(self.na, self.nb))
 
@@ -220,27 +655,96 @@ class SUBNET_CT(nn.Module):
     def encoder_unbached(self, upast, ypast):
         return self.encoder(upast[None],ypast[None])[0]
 
+###########################
+### Streaming simulator ###
+###########################
+
+class Streaming_simulator:
+    '''Stateful simulator of a SUBNET or SUBNET_CT for real-time use where one input sample arrives at the time.
+
+    The first max(na, nb) calls of `step(u, y)` require the measured output y and fill a ring buffer of past samples,
+    after which the state is estimated with the encoder. Every following call `step(u)` returns the simulated output
+    at the current time and advances the state with f (or the integrator of SUBNET_CT at a fixed sampling time) in O(1)
+    using the unbatched functions, preallocated input tensors and without autograd. If the measured y keeps being
+    given it is stored in the ring buffer such that the state can be re-estimated from the most recent window with `encode()`.
+
+    Example usage:
+        sim = Streaming_simulator(model)
+        for uk, yk in zip(u_init, y_init): sim.step(uk, yk) #initialization
+        while True: y_sim = sim.step(read_input())
+    '''
+    def __init__(self, model: SUBNET | SUBNET_CT, sampling_time: float=None):
+        assert isinstance(model, (SUBNET, SUBNET_CT)), f'Streaming_simulator is only implemented for SUBNET and SUBNET_CT, not {model.__class__.__name__}'
+        self.model, self.continuous_time = model, isinstance(model, SUBNET_CT)
+        self.na, self.nb, self.npast = model.na, model.nb, max(model.na, model.nb)
+        device = next(model.parameters()).device
+        shape = lambda n: () if n=='scalar' else (n,)
+        self.u = torch.zeros(shape(model.nu), device=device)
+        self.u_buffer = torch.zeros((self.npast,) + shape(model.nu), device=device)
+        self.y_buffer = torch.zeros((self.npast,) + shape(model.ny), device=device)
+        sampling_time = model.norm.sampling_time if sampling_time is None else sampling_time
+        self.sampling_time = torch.as_tensor(sampling_time, dtype=torch.float32, device=device)
+        self.reset()
+
+    def reset(self):
+        '''Empties the ring buffer and the state such that the next max(na, nb) steps initialize again.'''
+        self.x, self.position, self.n_buffered = None, 0, 0
+
+    @property
+    def initialized(self):
+        return self.x is not None
+
+    def encode(self):
+        '''(Re-)estimates the state from the last max(na, nb) buffered samples.'''
+        assert self.n_buffered==self.npast, f'the encoder requires {self.npast} buffered samples but only got {self.n_buffered}'
+        with torch.inference_mode():
+            order = (self.position + torch.arange(self.npast, device=self.u.device)) % self.npast #oldest sample first
+            upast, ypast = self.u_buffer[order][self.npast-self.nb:], self.y_buffer[order][self.npast-self.na:]
+            self.x = self.model.encoder_unbached(upast, ypast)
+
+    def step(self, u, y=None):
+        '''Processes the input u (and optionally the measured output y) of the current time. Returns None during
+        the initialization and the simulated output at the current time (as a numpy array) afterwards.'''
+        with torch.inference_mode():
+            self.u.copy_(torch.as_tensor(u, dtype=torch.float32))
+            if y is not None:
+                self.u_buffer[self.position] = self.u
+                self.y_buffer[self.position] = torch.as_tensor(y, dtype=torch.float32)
+                self.position, self.n_buffered = (self.position + 1) % self.npast, min(self.n_buffered + 1, self.npast)
+            if self.x is None:
+                assert y is not None, f'the measured output y is required for the first {self.npast} steps to initialize the state'
+                if self.n_buffered==self.npast:
+                    self.encode()
+                return None
+            model = self.model
+            yout = model.h_unbached(self.x, self.u)
+            if self.continuous_time:
+                self.x = model.integrator_unbached(model.f_CT, self.x, self.u, self.sampling_time)
+            else:
+                self.x = model.f_unbached(self.x, self.u)
+            return yout.cpu().numpy()
+
 ###############################################
 ### Helper Function for Fully Custom SUBNET ###
 ###############################################
 
 class Custom_SUBNET(nn.Module):
-    def create_arrays(self, data: Input_output_data | list, T : int=50, stride: int=1):
-        return past_future_arrays(data, self.na, self.nb, T=T, stride=stride, add_sampling_time=False)
+    def create_arrays(self, data: Input_output_data | list, T : int=50, stride: int=1, **kwargs):
+        return past_future_arrays(data, self.na, self.nb, T=T, stride=stride, add_sampling_time=False, **kwargs)
 
-    def simulate(self, data: Input_output_data | list):
+    def simulate(self, data: Input_output_data | list, batched: bool=False):
         if isinstance(data, (list, tuple)):
-            return [self.simulate(d) for d in data]
+            return simulate_batched(self, data, add_sampling_time=False) if batched else [self.simulate(d) for d in data]
         ysim = self(*past_future_arrays(data, self.na, self.nb, T='sim', add_sampling_time=False)[0])[0].detach().numpy()
         return Input_output_data(u=data.u, y=np.concatenate([data.y[:max(self.na, self.nb)],ysim],axis=0), state_initialization_window_length=max(self.na, self.nb))
 
 class Custom_SUBNET_CT(nn.Module):
-    def create_arrays(self, data: Input_output_data | list, T : int=50, stride: int=1):
-        return past_future_arrays(data, self.na, self.nb, T=T, stride=stride, add_sampling_time=True)
+    def create_arrays(self, data: Input_output_data | list, T : int=50, stride: int=1, **kwargs):
+        return past_future_arrays(data, self.na, self.nb, T=T, stride=stride, add_sampling_time=True, **kwargs)
 
-    def simulate(self, data: Input_output_data | list):
+    def simulate(self, data: Input_output_data | list, batched: bool=False):
         if isinstance(data, (list, tuple)):
-            return [self.simulate(d) for d in data]
+            return simulate_batched(self, data, add_sampling_time=True) if batched else [self.simulate(d) for d in data]
         ysim = self(*past_future_arrays(data, self.na, self.nb, T='sim', add_sampling_time=True)[0])[0].detach().numpy()
         return Input_output_data(u=data.u, y=np.concatenate([data.y[:max(self.na, self.nb)],ysim],axis=0), state_initialization_window_length=max(self.na, self.nb))
 
@@ -268,7 +772,7 @@ def validate_custom_SUBNET_structure(model):
 # Verhoek, Chris, et al. "Deep-learning-based identification of LPV models for nonlinear systems." 2022 IEEE 61st Conference on Decision and Control (CDC). IEEE, 2022.
 
 from deepSI.networks import Bilinear
-class SUBNET_LPV(Custom_SUBNET):
+class SUBNET_LPV(Unroll_checkpointing_mixin, Custom_SUBNET):
     def __init__(self, nu, ny, norm:Norm, nx, n_schedual, na, nb, scheduling_net=None, A=None, B=None, C=None, D=None, encoder=None, feedthrough=True):
         if np.any(10*abs(norm.ymean.numpy())>norm.ystd.numpy()) or np.any(10*abs(norm.umean.numpy())>norm.ustd.numpy()):
             from warnings import warn
@@ -285,16 +789,26 @@ class SUBNET_LPV(Custom_SUBNET):
         validate_custom_SUBNET_structure(self) #does checks if forward is working as intended
     
     def forward(self, upast: torch.Tensor, ypast: torch.Tensor, ufuture: torch.Tensor, yfuture: torch.Tensor=None):
+        x = self.encoder(upast, ypast)
+        return self.unroll(x, ufuture)[0]
+
+    def unroll(self, x: torch.Tensor, ufuture: torch.Tensor, pfuture: torch.Tensor=None):
+        '''Simulates from x over ufuture and returns (yfuture_sim, x), the scheduling is computed from (x, u) unless pfuture is given.'''
+        sequences = (ufuture,) if pfuture is None else (ufuture, pfuture)
+        if getattr(self, 'unroll_checkpointing', None) is not None:
+            return self.unroll_checkpointing(self.unroll_segment, x, *sequences)
+        return self.unroll_segment(x, *sequences)
+
+    def unroll_segment(self, x: torch.Tensor, ufuture: torch.Tensor, pfuture: torch.Tensor=None):
         mv = lambda A, x: torch.bmm(A, x[:, :, None])[:,:,0] #batched matrix vector multiply
         yfuture_sim = []
-        x = self.encoder(upast, ypast)
-        for u in ufuture.swapaxes(0,1): #iterate over time
-            p = self.scheduling_net(x, u)
+        for t, u in enumerate(ufuture.swapaxes(0,1)): #iterate over time
+            p = self.scheduling_net(x, u) if pfuture is None else pfuture[:,t]
             A, B, C, D = self.A(p), self.B(p), self.C(p), self.D(p)
             y = mv(C, x) + mv(D, u)
             x = mv(A, x) + mv(B, u)
             yfuture_sim.append(y)
-        return torch.stack(yfuture_sim, dim=1)
+        return torch.stack(yfuture_sim, dim=1), x
 
 
 class SUBNET_LPV_ext_scheduled(SUBNET_LPV):
@@ -308,15 +822,7 @@ class SUBNET_LPV_ext_scheduled(SUBNET_LPV):
         x_long = torch.unflatten(self.encoder(upasts, ypasts), dim=0, sizes=(Nbatch, T)) #use encoder to estimate all the initial state in the future
         pfuture = torch.unflatten(self.scheduling_net(x_long.flatten(0,1), ufuture.flatten(0,1)), dim=0, sizes=(Nbatch, T)) #construct scheduling parameters
         x = x_long[:,0] #set initial state equal to the first of the inital states computed
-
-        mv = lambda A, x: torch.bmm(A, x[:, :, None])[:,:,0] #batched matrix vector multiply
-        yfuture_sim = []
-        for p, u in zip(pfuture.swapaxes(0,1), ufuture.swapaxes(0,1)): #iterate over time
-            A, B, C, D = self.A(p), self.B(p), self.C(p), self.D(p)
-            y = mv(C, x) + mv(D, u)
-            x = mv(A, x) + mv(B, u)
-            yfuture_sim.append(y)
-        return torch.stack(yfuture_sim, dim=1)
+        return self.unroll(x, ufuture, pfuture)[0]
 
 ##########################
 ####### CNN_SUBNET #######
@@ -338,11 +844,14 @@ class CNN_SUBNET(SUBNET):
 # see: https://arxiv.org/abs/2305.01338
 # Moradi, Sarvin, et al. "Physics-Informed Learning Using Hamiltonian Neural Networks with Output Error Noise Models." IFAC-PapersOnLine 56.2 (2023): 5152-5157.
 
-from deepSI.networks import Ham_converter, ELU_lower_bound, Skew_sym_converter, Sym_pos_semidef_converter, Matrix_converter
+from deepSI.networks import Ham_converter, ELU_lower_bound, Skew_sym_converter, Sym_pos_semidef_converter, Matrix_converter, Stacked_MLP_res_nets
 class pHNN_SUBNET(Custom_SUBNET_CT):
     def __init__(self, nu : int | str, ny: int | str, norm : Norm, nx : int, na : int, nb : int, Hnet : None | nn.Module =None, Jnet : None | nn.Module =None, \
-                 Rnet : None | nn.Module =None, Gnet : None | nn.Module =None, encoder : None | nn.Module =None, integrator=None, tau : float =None):
+                 Rnet : None | nn.Module =None, Gnet : None | nn.Module =None, encoder : None | nn.Module =None, integrator=None, tau : float =None, \
+                 fast : bool =False):
+        '''With fast=True the forward uses `forward_fast` (same model, faster evaluation).'''
         super().__init__()
+        self.fast = fast
         assert nu==ny
         self.nu, self.ny, self.norm, self.nx, self.na, self.nb = nu, ny, norm, nx, na, nb
         self.Hnet = Ham_converter(ELU_lower_bound(MLP_res_net(nx, 'scalar'))) if Hnet is None else Hnet
@@ -380,7 +889,50 @@ class pHNN_SUBNET(Custom_SUBNET_CT):
         G_x = self.Gnet(x)
         return J_x, R_x, G_x, dHdx, H
 
+    def get_matricies_fast(self):
+        '''Returns a function x -> (J_x, R_x, G_x, dHdx) where the J, R and G networks are evaluated as one stacked network 
+        (see `Stacked_MLP_res_nets`) if they are the default converters of compatible MLP_res_nets and dH/dx is computed 
+        with a single gradient of the batch sum of H which only creates the graph for the backward if gradients are enabled.
+        (torch.func.vmap(torch.func.grad(H)) gives the same result but was measured to be 1.6-2.5x slower on cpu.)
+        Create it once per forward such that the weights are only stacked once.'''
+        def dHdx(x):
+            create_graph = torch.is_grad_enabled()
+            with torch.enable_grad():
+                x = x if x.requires_grad else x.detach().requires_grad_()
+                return torch.autograd.grad(self.Hnet(x).sum(), x, create_graph=create_graph)[0]
+        nets = [getattr(conv, 'net', None) for conv in (self.Jnet, self.Rnet, self.Gnet)]
+        if not (all(hasattr(conv, 'convert') for conv in (self.Jnet, self.Rnet, self.Gnet)) and Stacked_MLP_res_nets.compatible(nets)):
+            return lambda x: (self.Jnet(x), self.Rnet(x), self.Gnet(x), dHdx(x))
+        stacked = Stacked_MLP_res_nets(nets)
+        def matricies(x):
+            zJ, zR, zG = stacked(x)
+            return self.Jnet.convert(zJ), self.Rnet.convert(zR), self.Gnet.convert(zG), dHdx(x)
+        return matricies
+
+    def forward_fast(self, upast, ypast, ufuture, sampling_time, yfuture=None):
+        '''Same as forward but evaluates the matricies with `get_matricies_fast` and reuses the evaluation at the start of 
+        each time step (used for the output) for the first stage of the integrator.'''
+        x = self.encoder(upast, ypast)
+        ufuture = (ufuture.view(ufuture.shape[0],ufuture.shape[1],-1)-self.norm.umean)/self.norm.ustd #normalize inputs
+        matricies = self.get_matricies_fast()
+        start = [None, None] #(x, matricies(x)) at the start of the current time step
+        def f_CT(x, u):
+            J_x, R_x, G_x, dHdx = start[1] if x is start[0] else matricies(x)
+            Gu = torch.einsum('bij,bj->bi', G_x, u)
+            return (torch.einsum('bij,bj->bi', J_x - R_x, dHdx) + Gu)/self.tau
+        yfuture_sim = []
+        for u in ufuture.swapaxes(0,1):
+            start[:] = x, matricies(x)
+            J_x, R_x, G_x, dHdx = start[1]
+            yfuture_sim.append(torch.einsum('bij,bi->bj', G_x, dHdx))
+            x = self.integrator(f_CT, x, u, sampling_time)
+        yfuture_sim = torch.stack(yfuture_sim, dim=1)
+        yfuture_sim = yfuture_sim[:,:,0] if self.ny=='scalar' else yfuture_sim
+        return yfuture_sim*self.norm.ystd + self.norm.ymean
+
     def forward(self, upast, ypast, ufuture, sampling_time, yfuture=None):
+        if getattr(self, 'fast', False):
+            return self.forward_fast(upast, ypast, ufuture, sampling_time, yfuture)
         x = self.encoder(upast, ypast)
         ufuture = (ufuture.view(ufuture.shape[0],ufuture.shape[1],-1)-self.norm.umean)/self.norm.ustd #normalize inputs
         yfuture_sim = []
@@ -405,7 +957,7 @@ class pHNN_SUBNET(Custom_SUBNET_CT):
 # see: https://ieeexplore.ieee.org/abstract/document/9682946
 # Iacob, Lucian Cristian, et al. "Deep identification of nonlinear systems in Koopman form." 2021 60th IEEE Conference on Decision and Control (CDC). IEEE, 2021.
 
-class Koopman_SUBNET(Custom_SUBNET):
+class Koopman_SUBNET(Unroll_checkpointing_mixin, Custom_SUBNET):
     '''Implements the following structure
     x_next = A@x + B(x)@(u - umean)/ustd
     y = (C@x) * ystd + ymean
@@ -431,12 +983,27 @@ class Koopman_SUBNET(Custom_SUBNET):
             self.D = None
 
     def forward(self, upast: torch.Tensor, ypast: torch.Tensor, ufuture: torch.Tensor, yfuture: torch.Tensor=None):
-        mv = lambda A, x: torch.bmm(A, x[:, :, None])[:,:,0] #batched matrix vector multiply
-        yfuture_sim = []
         x = self.encoder(upast, ypast) #initial state
-        Nbatch = upast.shape[0]
+        return self.unroll(x, ufuture)[0]
+
+    def unroll(self, x: torch.Tensor, ufuture: torch.Tensor):
+        '''Simulates from the initial state x over ufuture and returns (yfuture_sim, x).'''
+        Nbatch = x.shape[0]
         ufuture = (ufuture - self.norm.umean)/self.norm.ustd # Normalize input
         ufuture = ufuture.view(Nbatch, ufuture.shape[1], -1) # Convert all the u from scalars to vectors if needed
+        if getattr(self, 'unroll_checkpointing', None) is not None:
+            yfuture_sim, x = self.unroll_checkpointing(self.unroll_segment, x, ufuture)
+        else:
+            yfuture_sim, x = self.unroll_segment(x, ufuture)
+        if self.ny=='scalar':
+            yfuture_sim = yfuture_sim[:,:,0]
+        return yfuture_sim*self.norm.ystd + self.norm.ymean, x
+
+    def unroll_segment(self, x: torch.Tensor, ufuture: torch.Tensor):
+        '''Unroll over the normalized ufuture (Nbatch, T, nu_vals), returns the normalized output.'''
+        mv = lambda A, x: torch.bmm(A, x[:, :, None])[:,:,0] #batched matrix vector multiply
+        yfuture_sim = []
+        Nbatch = x.shape[0]
         # Add batch dimension to matrixes
         A = torch.broadcast_to(self.A, (Nbatch, self.nx, self.nx)) 
         C = torch.broadcast_to(self.C, (Nbatch, self.ny_vals, self.nx))
@@ -446,7 +1013,4 @@ class Koopman_SUBNET(Custom_SUBNET):
             yfuture_sim.append(y)
             B = self.Bnet(x) if self.B_depends_on_u==False else self.Bnet(x, u[:,0] if self.nu=='scalar' else u) #removes the vector dim if it is scalar
             x = mv(A,x) + mv(B, u)
-        yfuture_sim = torch.stack(yfuture_sim, dim=1)
-        if self.ny=='scalar':
-            yfuture_sim = yfuture_sim[:,:,0]
-        return yfuture_sim*self.norm.ystd + self.norm.ymean
+        return torch.stack(yfuture_sim, dim=1), x
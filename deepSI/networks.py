@@ -59,6 +59,46 @@ class MLP_res_net(nn.Module):
             net_in = torch.cat([a.view(a.shape[0], -1) for a in ars],dim=1) #flattens everything
         out = self.net_nonlin(net_in) + self.net_res(net_in)
         return out[:,0] if self.scalar_output else out
+
+class Stacked_MLP_res_nets:
+    '''Evaluates several MLP_res_net with the same input and the same hidden layers (e.g. the J, R and G networks of pHNN_SUBNET)
+    as one batched network: the first layers and the residual layers are concatenated into a single matrix multiply and the
+    hidden and last layers are evaluated with a single torch.baddbmm over the stacked (zero padded) weights.
+    The weights are stacked at construction (differentiable with respect to the parameters of the nets), hence create it 
+    once per forward such that the stacking is not repeated at every time step. Returns the same as [net(x) for net in nets].'''
+    def __init__(self, nets: list):
+        assert self.compatible(nets), 'the nets should be vector output MLP_res_nets with the same input size and hidden layers'
+        self.nets, self.out_sizes = nets, [net.net_res.out_features for net in nets]
+        self.activations = [m for m in nets[0].net_nonlin if not isinstance(m, nn.Linear)]
+        linears = [[m for m in net.net_nonlin if isinstance(m, nn.Linear)] for net in nets]
+        n_out = max(self.out_sizes)
+        pad = lambda x, n: torch.nn.functional.pad(x, (0, 0)*(x.ndim - 1) + (0, n - x.shape[0])) #zero pad the first dim to n
+        self.W_first, self.b_first = torch.cat([l[0].weight for l in linears]), torch.cat([l[0].bias for l in linears])
+        self.W_res, self.b_res = torch.cat([net.net_res.weight for net in nets]), torch.cat([net.net_res.bias for net in nets])
+        self.W_hidden = [torch.stack([l[i].weight.T for l in linears]) for i in range(1, len(linears[0]) - 1)]
+        self.b_hidden = [torch.stack([l[i].bias for l in linears])[:, None] for i in range(1, len(linears[0]) - 1)]
+        self.W_last = torch.stack([pad(l[-1].weight, n_out).T for l in linears])
+        self.b_last = torch.stack([pad(l[-1].bias, n_out) for l in linears])[:, None]
+
+    @staticmethod
+    def compatible(nets: list) -> bool:
+        if not all(isinstance(net, MLP_res_net) and not net.scalar_output for net in nets):
+            return False
+        layers = [[(type(m), m.in_features if isinstance(m, nn.Linear) else None, m.out_features if isinstance(m, nn.Linear) else None) \
+                   for m in net.net_nonlin] for net in nets]
+        strip_out = lambda l: l[:-1] + [l[-1][:2]] #the output sizes can differ
+        return all(strip_out(l)==strip_out(layers[0]) for l in layers) and \
+            all(len(list(m.parameters()))==0 for m in nets[0].net_nonlin if not isinstance(m, nn.Linear))
+
+    def __call__(self, *ars):
+        x = ars[0].view(ars[0].shape[0], -1) if len(ars)==1 else torch.cat([a.view(a.shape[0], -1) for a in ars], dim=1)
+        B, k = x.shape[0], len(self.nets)
+        h = self.activations[0]((x @ self.W_first.T + self.b_first).view(B, k, -1).transpose(0, 1)) #(k, B, n_hidden_nodes)
+        for W, b, activation in zip(self.W_hidden, self.b_hidden, self.activations[1:]):
+            h = activation(torch.baddbmm(b, h, W))
+        out = torch.baddbmm(self.b_last, h, self.W_last) #(k, B, max output size)
+        res = (x @ self.W_res.T + self.b_res).split(self.out_sizes, dim=1)
+        return [out[i, :, :n] + r for i, (n, r) in enumerate(zip(self.out_sizes, res))]
     
 ###########################
 ###### Integrators ########
@@ -93,6 +133,142 @@ def rk45_integrator(f, x, u, dt, n_steps=1):
         x = x + (16 * k1 / 135 + 6656 * k3 / 12825 + 28561 * k4 / 56430 - 9 * k5 / 50 + 2 * k6 / 55)
     return x
 
+#Butcher tableaus of embedded 5(4) pairs, b propagates the solution (5th order) and b_hat is the embedded 4th order solution
+dopri5_tableau = dict(A=[[], [1/5], [3/40, 9/40], [44/45, -56/15, 32/9], [19372/6561, -25360/2187, 64448/6561, -212/729], \
+                         [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656], [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]], \
+                      b=[35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0], \
+                      b_hat=[5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40], fsal=True) #first same as last
+rkf45_tableau = dict(A=[[], [1/4], [3/32, 9/32], [1932/2197, -7200/2197, 7296/2197], [439/216, -8, 3680/513, -845/4104], \
+                        [-8/27, 2, -3544/2565, 1859/4104, -11/40]], \
+                     b=[16/135, 0, 6656/12825, 28561/56430, -9/50, 2/55], b_hat=[25/216, 0, 1408/2565, 2197/4104, -1/5, 0], fsal=False)
+
+class Adaptive_integrator:
+    '''Batched adaptive step size integrator with an embedded error estimate and a PI step size controller, 
+    which can be used as `SUBNET_CT(..., integrator=Adaptive_integrator(rtol=1e-3, atol=1e-6))`.
+
+    Each sample of the batch is integrated over its own dt (u is kept constant) with its own step size and number of steps. 
+    Every iteration only the samples which have not yet reached dt are evaluated (masking by the active index set), 
+    steps with a scaled error norm > 1 are rejected and retried with a smaller step size. The step size is 
+    controlled as h_new = h*safety*err**(-alpha)*err_prev**beta. The decisions of the controller are not differentiated.
+    
+    method: 'dopri5' (Dormand-Prince, uses the first same as last property: 6 evaluations of f per step) or 'rkf45' (Fehlberg, 6 per step).
+    first_step: initial step size as a fraction of dt.
+
+    The number of function evaluations is counted in `nfev` (batched calls of f) and `nfev_samples` (evaluated samples), 
+    the accepted and rejected steps summed over the samples in `n_accepted` and `n_rejected` (all reset with `reset_stats()`). 
+    `last_steps` holds the number of accepted steps of each sample of the last call.
+    Note that the loop is data dependent, hence it cannot be used with torch.compile or exported.'''
+    def __init__(self, rtol: float=1e-3, atol: float=1e-6, method: str='dopri5', first_step: float=1., safety: float=0.9, \
+                 min_factor: float=0.2, max_factor: float=5., alpha: float=0.7/5, beta: float=0.4/5, max_iterations: int=10_000):
+        assert method in ('dopri5', 'rkf45'), f"method should be 'dopri5' or 'rkf45' but got {method}"
+        self.rtol, self.atol, self.method, self.first_step, self.safety = rtol, atol, method, first_step, safety
+        self.min_factor, self.max_factor, self.alpha, self.beta, self.max_iterations = min_factor, max_factor, alpha, beta, max_iterations
+        self.tableau = dopri5_tableau if method=='dopri5' else rkf45_tableau
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.nfev, self.nfev_samples, self.n_accepted, self.n_rejected, self.last_steps = 0, 0, 0, 0, None
+
+    def __call__(self, f, x, u, dt):
+        A, b, b_hat, fsal = self.tableau['A'], self.tableau['b'], self.tableau['b_hat'], self.tableau['fsal']
+        B = x.shape[0]
+        dt = torch.as_tensor(dt, dtype=x.dtype, device=x.device).expand(B).contiguous()
+        t, h, err_prev = torch.zeros_like(dt), dt*self.first_step, torch.ones_like(dt)
+        n_steps = torch.zeros(B, dtype=torch.long, device=x.device)
+        active, k_first = torch.arange(B, device=x.device), None #k_first holds f(x) for fsal
+        comb = lambda coefs, ks: sum(c*k for c, k in zip(coefs, ks) if c!=0)
+        for _ in range(self.max_iterations):
+            if len(active)==0:
+                break
+            xa, ua = x[active], u[active]
+            with torch.no_grad():
+                ha = torch.minimum(h[active], dt[active] - t[active])
+            hp = ha.view((-1,) + (1,)*(x.ndim - 1))
+            ks = [k_first[active] if k_first is not None else f(xa, ua)]
+            for Ai in A[1:]:
+                ks.append(f(xa + hp*comb(Ai, ks), ua))
+            self.nfev += len(ks) - (k_first is not None)
+            self.nfev_samples += len(active)*(len(ks) - (k_first is not None))
+            x_new = xa + hp*comb(b, ks)
+            with torch.no_grad(): #error norm and step size controller
+                scale = self.atol + self.rtol*torch.maximum(xa.abs(), x_new.abs())
+                err = (hp*comb([bi - bhi for bi, bhi in zip(b, b_hat)], ks)/scale).pow(2).flatten(1).mean(1).sqrt().clamp(min=1e-10)
+                accept = err<=1
+                factor = torch.where(accept, self.safety*err**(-self.alpha)*err_prev[active]**self.beta, self.safety*err**(-1/5))
+                factor = torch.minimum(factor.clamp(min=self.min_factor), torch.where(accept, self.max_factor, 1.)) #no increase after a rejection
+                h[active] = ha*factor
+                done = accept & (ha >= dt[active] - t[active])
+                t[active] = torch.where(done, dt[active], torch.where(accept, t[active] + ha, t[active]))
+                err_prev[active] = torch.where(accept, err, err_prev[active])
+                n_steps[active] += accept
+                self.n_accepted += int(accept.sum())
+                self.n_rejected += int((~accept).sum())
+            accepted = active[accept]
+            x = x.index_put((accepted,), x_new[accept])
+            if fsal: #the last stage is f(x_new) which is the first stage of the next step
+                k_next = torch.where(accept.view(hp.shape), ks[-1], ks[0])
+                k_first = (torch.zeros_like(x) if k_first is None else k_first).index_put((active,), k_next)
+            active = active[~done]
+        else:
+            raise RuntimeError(f'Adaptive_integrator did not reach dt within max_iterations={self.max_iterations} iterations (stiff or unstable f?)')
+        self.last_steps = n_steps
+        return x
+
+class Adjoint_rk4(torch.autograd.Function):
+    '''x_next = rk4_integrator(f, x, u, dt, n_steps) without storing the stages, the gradient is computed by integrating 
+    the adjoint (augmented) ODE backwards from x_next with rk4, see `Adjoint_integrator`.'''
+    @staticmethod
+    def forward(ctx, f, n_steps, x, u, dt, *params):
+        x_next = rk4_integrator(f, x, u, dt, n_steps=n_steps) #autograd is disabled inside forward
+        ctx.f, ctx.n_steps = f, n_steps
+        ctx.save_for_backward(x_next, u, dt, *params)
+        return x_next
+
+    @staticmethod
+    def backward(ctx, a):
+        x, u, dt, *params = ctx.saved_tensors
+        f, n_steps = ctx.f, ctx.n_steps
+        hp = (dt/n_steps).view((-1,) + (1,)*(x.ndim - 1))
+        u_grad = ctx.needs_input_grad[3]
+        def stage(x, a): #(dx, da, du, dparams) for a step of -h in time with x' = f(x,u) and a' = -a df/dx
+            with torch.enable_grad():
+                x_, u_ = x.detach().requires_grad_(), u.detach().requires_grad_(u_grad)
+                fx = f(x_, u_)
+                grads = torch.autograd.grad(fx, (x_, u_) + tuple(params) if u_grad else (x_,) + tuple(params), a*hp, allow_unused=True)
+            grads = [torch.zeros_like(p) if g is None else g for g, p in zip(grads, ((x_, u_) if u_grad else (x_,)) + tuple(params))]
+            return [-hp*fx.detach()] + grads
+        z = [x, a] #state of the backward integration, the remaining (u and parameter) gradients are accumulated
+        acc = None
+        for _ in range(n_steps):
+            k1 = stage(*z)
+            k2 = stage(z[0] + k1[0]/2, z[1] + k1[1]/2)
+            k3 = stage(z[0] + k2[0]/2, z[1] + k2[1]/2)
+            k4 = stage(z[0] + k3[0], z[1] + k3[1])
+            step = [(c1 + 2*c2 + 2*c3 + c4)/6 for c1, c2, c3, c4 in zip(k1, k2, k3, k4)]
+            z = [z[0] + step[0], z[1] + step[1]]
+            acc = step[2:] if acc is None else [g + s for g, s in zip(acc, step[2:])]
+        grad_u = acc.pop(0) if u_grad else None
+        return (None, None, z[1], grad_u, None, *acc)
+
+class Adjoint_integrator:
+    '''rk4 integrator with a memory-efficient adjoint gradient, use as `SUBNET_CT(..., integrator=Adjoint_integrator(n_steps))`.
+
+    The forward pass stores only x_next of each time step instead of every rk4 stage (and the activations of f_CT) of every 
+    integration step, hence the memory of the unroll no longer grows with n_steps*4. The backward pass integrates the adjoint 
+    ODE a' = -a df/dx (and the parameter and input gradients) backwards in time from x_next with rk4 using the same n_steps, 
+    reconstructing x along the way. The result is the gradient of the continuous-time solution which approximates the 
+    direct backpropagation gradient with an error of the order of the integration error (see `deepSI.fitting.adjoint_gradient_error`) 
+    at about twice the compute of the backward pass. f should be an nn.Module (e.g. the default f_CT).'''
+    def __init__(self, n_steps: int=1):
+        self.n_steps = n_steps
+
+    def __call__(self, f, x, u, dt):
+        assert isinstance(f, nn.Module), 'Adjoint_integrator requires f to be a nn.Module such that its parameters are known'
+        dt = torch.as_tensor(dt, dtype=x.dtype, device=x.device).expand(x.shape[0]).contiguous()
+        if not torch.is_grad_enabled():
+            return rk4_integrator(f, x, u, dt, n_steps=self.n_steps)
+        return Adjoint_rk4.apply(f, self.n_steps, x, u, dt, *[p for p in f.parameters() if p.requires_grad])
+
 ##################################
 ##### LPV SUBNET networks ########
 ##################################
@@ -400,7 +576,10 @@ class Matrix_converter(nn.Module):
         self.ncols = ncols
 
     def forward(self, *x):
-        A = self.net(*x).view(x[0].shape[0], self.nrows, self.ncols)
+        return self.convert(self.net(*x))
+
+    def convert(self, z):
+        A = z.view(z.shape[0], self.nrows, self.ncols)
         if self.norm=='auto':
             A = A/(self.ncols**0.5) #this can be improved with some additional math 
         else:
@@ -418,7 +597,9 @@ class Skew_sym_converter(nn.Module):
         self.norm = norm
 
     def forward(self, x):
-        z = self.net(x)
+        return self.convert(self.net(x))
+
+    def convert(self, z):
         #z.shape = (Nbatch, nx*nx)
         nx = int(round(z.shape[1]**0.5))
         assert nx*nx==z.shape[1], 'the output of net needs to have a sqaure number of elements to be reshaped to a square matrix'
@@ -440,7 +621,9 @@ class Sym_pos_semidef_converter(nn.Module):
         self.net = net
 
     def forward(self, x):
-        z = self.net(x)
+        return self.convert(self.net(x))
+
+    def convert(self, z):
         nx = int(round(z.shape[1]**0.5))
         assert nx*nx==z.shape[1], 'the output of net needs to have a sqaure number of elements to be reshaped to a square matrix'
         A = z.view(z.shape[0], nx, nx)
@@ -64,22 +64,137 @@ class Norm:
                 f"ymean={self.ymean.numpy()}, ystd={self.ystd.numpy()}, "
                 f"sampling_time={self.sampling_time.numpy()})")
 
-def get_nu_ny_and_auto_norm(data: nlb.Input_output_data | list):
+class Running_stats:
+    '''One-pass mean and variance over the first axis which can be updated with chunks of data and merged with the
+    statistics of other chunks, datasets or workers (Welford/Chan et al. parallel algorithm, accumulated in float64).
+    Example: `stats = Running_stats().update(x[:1000]).update(x[1000:])` or `stats = stats_a.merge(stats_b)`'''
+    def __init__(self, n: int=0, mean=0., M2=0.):
+        self.n, self.mean, self.M2 = n, np.asarray(mean, dtype=np.float64), np.asarray(M2, dtype=np.float64)
+
+    def update(self, x, chunk_size: int=2**20):
+        '''Adds the samples x (e.g. a np.memmap) in chunks of `chunk_size` samples such that x is never converted as a whole.'''
+        for start in range(0, len(x), chunk_size):
+            chunk = np.asarray(x[start:start + chunk_size], dtype=np.float64)
+            mean = chunk.mean(0)
+            self.merge(Running_stats(len(chunk), mean, ((chunk - mean)**2).sum(0)))
+        return self
+
+    def merge(self, other: 'Running_stats'):
+        '''Combines the statistics of other into self.'''
+        if other.n==0:
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta*(other.n/n)
+        self.M2 = self.M2 + other.M2 + delta**2*(self.n*other.n/n)
+        self.n = n
+        return self
+
+    @property
+    def var(self):
+        return self.M2/self.n
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def __repr__(self):
+        return f"Running_stats(n={self.n}, mean={self.mean}, std={self.std if self.n>0 else None})"
+
+def get_io_stats(data: nlb.Input_output_data | list, chunk_size: int=2**20):
+    '''Returns the Running_stats of u and of y over all the given datasets (streamed in chunks of `chunk_size` samples).
+    The results of different workers can be combined with `.merge` and passed to `get_nu_ny_and_auto_norm`.'''
+    if not isinstance(data, (tuple, list)):
+        data = [data]
+    ustats, ystats = Running_stats(), Running_stats()
+    for d in data:
+        assert d.u.ndim<=2 and d.y.ndim<=2, f'auto norm only defined for scalar or vector outputs y and input u {d.y.shape=} {d.u.shape=}'
+        ustats.update(d.u, chunk_size)
+        ystats.update(d.y, chunk_size)
+    return ustats, ystats
+
+def get_nu_ny_and_auto_norm(data: nlb.Input_output_data | list, chunk_size: int=2**20, stats: tuple=None):
+    '''Returns nu, ny and the Norm (mean and std of u and y) of the given data. The statistics are computed in a single
+    streaming pass over chunks of `chunk_size` samples such that the data is not concatenated (memory-mapped data is supported).
+    Precomputed and merged statistics `(ustats, ystats)` of `get_io_stats` can be given with `stats`.'''
     if not isinstance(data, (tuple, list)):
         data = [data]
-    u = np.concatenate([d.u for d in data],axis=0)
-    y = np.concatenate([d.y for d in data],axis=0)
-    assert u.ndim<=2 and y.ndim<=2, f'auto norm only defined for scalar or vector outputs y and input u {y.shape=} {u.shape=}'
     sampling_time = data[0].sampling_time
     assert all(sampling_time==d.sampling_time for d in data), f"the given datasets don't have all the sample sampling_time set {[d.sampling_time for d in data]=}"
-    umean, ustd = u.mean(0), u.std(0)
-    ymean, ystd = y.mean(0), y.std(0)
-    norm = Norm(umean, ustd, ymean, ystd, sampling_time)
-    nu = 'scalar' if u.ndim==1 else u.shape[1]
-    ny = 'scalar' if y.ndim==1 else y.shape[1]
+    ustats, ystats = get_io_stats(data, chunk_size) if stats is None else stats
+    norm = Norm(ustats.mean, ustats.std, ystats.mean, ystats.std, sampling_time)
+    nu = 'scalar' if ustats.mean.ndim==0 else ustats.mean.shape[0]
+    ny = 'scalar' if ystats.mean.ndim==0 else ystats.mean.shape[0]
     return nu, ny, norm
 
+###########################
+### Fused normalization ###
+###########################
+
+def fold_input_affine(linear: torch.nn.Linear, scale: torch.Tensor, shift: torch.Tensor):
+    '''In place: linear(z*scale + shift) == linear_folded(z)'''
+    with torch.no_grad():
+        linear.bias += linear.weight @ shift
+        linear.weight *= scale[None, :]
+
+def fold_output_affine(linear: torch.nn.Linear, scale: torch.Tensor, shift: torch.Tensor=None):
+    '''In place: linear(z)*scale + shift == linear_folded(z)'''
+    with torch.no_grad():
+        linear.weight *= scale[:, None]
+        linear.bias *= scale
+        if shift is not None:
+            linear.bias += shift
 
+def fold_MLP_res_net(net, input_scales: list=None, input_shifts: list=None, output_scale=None, output_shift=None):
+    '''Folds elementwise affine transforms of the (flattened) inputs and of the output into the first and last nn.Linear layers
+    of both the residual and the nonlinear branch of a MLP_res_net (the output shift is only added once to the residual branch).'''
+    if input_scales is not None:
+        scale, shift = torch.cat([s.reshape(-1) for s in input_scales]), torch.cat([s.reshape(-1) for s in input_shifts])
+        fold_input_affine(net.net_res, scale, shift)
+        fold_input_affine(net.net_nonlin[0], scale, shift)
+    if output_scale is not None:
+        n_out = net.net_res.out_features
+        output_scale = torch.broadcast_to(output_scale, (n_out,))
+        fold_output_affine(net.net_res, output_scale, None if output_shift is None else torch.broadcast_to(output_shift, (n_out,)))
+        fold_output_affine(net.net_nonlin[-1], output_scale)
+    return net
 
+def fuse_normalization(model):
+    '''Returns a copy of a SUBNET or SUBNET_CT where the affine transforms of the Norm (and the 1/tau of f_CT) are folded 
+    into the first and last nn.Linear layers of the MLP_res_net networks of f (or f_CT), h and the encoder. 
+    The fused model computes the same function (up to float32 rounding) but no longer normalizes u at every call of f 
+    (four times per time step with rk4_integrator) or rescales every output of h, hence it is faster for simulation and training.
 
+    Only the default `Norm` wrappers around a MLP_res_net are fused, other (custom) networks are kept as they are.
+    Note that training the fused model optimizes the same model class in a rescaled parameterization.'''
+    from copy import deepcopy
+    from deepSI.networks import MLP_res_net
+    model = deepcopy(model)
+    def part(size, mean, std): #scale and shift of a flattened input part with size 'scalar', int or (n, 'scalar' | int)
+        if mean is None:
+            shape = (1,) if size=='scalar' else ((size,) if isinstance(size, int) else tuple(1 if s=='scalar' else s for s in size))
+            return torch.ones(shape), torch.zeros(shape)
+        shape = () if size=='scalar' else ((size,) if isinstance(size, int) else tuple(s for s in size if s!='scalar'))
+        return torch.broadcast_to(1/std, shape), torch.broadcast_to(-mean/std, shape)
+    def fold(wrapper, means_stds, out_scale=None, out_shift=None):
+        net = wrapper.fun
+        if not isinstance(net, MLP_res_net) or not isinstance(net.input_size, (list, int, str)):
+            return wrapper
+        sizes = net.input_size if isinstance(net.input_size, list) else [net.input_size]
+        if len(sizes)>len(means_stds):
+            return wrapper
+        parts = [part(size, *ms) for size, ms in zip(sizes, means_stds)] #x comes first such that h without feedthrough only uses the first
+        return fold_MLP_res_net(net, [p[0] for p in parts], [p[1] for p in parts], out_scale, out_shift)
 
+    f_name = 'f_CT' if hasattr(model, 'f_CT') else 'f'
+    f = getattr(model, f_name)
+    if isinstance(f, IO_normalization_f_CT):
+        setattr(model, f_name, fold(f, [(None, None), (f.umean, f.ustd)], 1/f.tau))
+    elif isinstance(f, IO_normalization_f):
+        setattr(model, f_name, fold(f, [(None, None), (f.umean, f.ustd)]))
+    h = model.h
+    if isinstance(h, IO_normalization_h):
+        model.h = fold(h, [(None, None), (h.umean, h.ustd)], h.ystd, h.ymean)
+    e = model.encoder
+    if isinstance(e, IO_normalization_encoder):
+        model.encoder = fold(e, [(e.umean, e.ustd), (e.ymean, e.ystd)])
+    return model